@@ -1,15 +1,24 @@
 from valis import registration
-import json
+import numpy as np
 import yaml
+import sys
+import os
+
+from registration_cache import get_registrar
+import instrumentation
+import pixel_store
 
 # Load the configuration file
 with open("config.yaml", "r") as file:
     config = yaml.load(file, Loader=yaml.FullLoader)
 
 # Hyperparameters
-lame = config["lame"]  # Name of the lame
+lame = sys.argv[1] if len(sys.argv) > 1 else config["lame"]  # Name of the lame (given by Snakemake or from the config)
 path = f"{config['path_to_data']}/{lame}"  # Path to the data
 
+# Record the time, memory and I/O of the registration and the warping if enabled
+report = instrumentation.Report("annotation_transfer", lame, config["instrumentation"])
+
 # Annotation and target images directory
 slide_src_dir = f"{path}/images/annotation"
 # Alignment results directory
@@ -18,29 +27,47 @@ results_dst_dir = f"{path}/results/annotation"
 annotation_img_f = f"{path}/images/annotation/MALDI.tif"
 # The target image to which the features will be aligned
 target_img_f = f"{path}/images/annotation/HES.svs"
-# The original features as geojson file
-annotation_geojson_f = f"{path}/results/{config['annotation_file']}"
-# The warped features aligned to the target image as geojson file
-warped_geojson_annotation_f = f"{path}/results/{config['warped_annotation_file']}"
-
-# Create a Valis object and use the target_img_file as reference
-registrar = registration.Valis(src_dir=slide_src_dir,
-                               dst_dir=results_dst_dir,
-                               reference_img_f=target_img_f,
-                               align_to_reference=config["align_to_reference"])
+# The original pixels as columnar arrays
+annotation_pixels_f = f"{path}/results/{config['annotation_file']}"
+# The warped pixels aligned to the target image as columnar arrays
+warped_pixels_annotation_f = f"{path}/results/{config['warped_annotation_file']}"
 
-# Apply the registration
-rigid_registrar, non_rigid_registrar, error_df = registrar.register()
+# Register the slides using the target_img_file as reference, or load their registration from the cache
+with report.span("registration"):
+    registrar = get_registrar(src_dir=slide_src_dir,
+                              dst_dir=results_dst_dir,
+                              reference_img_f=target_img_f,
+                              align_to_reference=config["align_to_reference"],
+                              cache_dir=f"{path}/results/registration" if config["registration_cache"] else None)
 
 # Register the annotation source slide from the MALDI.tif image
 annotation_source_slide = registrar.get_slide(src_f=annotation_img_f)
 # Register the annotation target slide from the HES.svs image
 target_slide = registrar.get_slide(src_f=target_img_f)
 
-# Transfer the annotation from MALDI.tif to HES.svs using the pixels.geojson file
-warped_geojson = annotation_source_slide.warp_geojson_from_to(geojson_f=annotation_geojson_f,
-                                                              to_slide_obj=target_slide)
+# Read the pixels from MALDI.tif
+pixels = pixel_store.read_pixels(annotation_pixels_f)
+
+# Transfer the corners of all the pixels from MALDI.tif to HES.svs at once
+with report.span("warp"):
+    corners = pixels["corners"][:, :-1].reshape(-1, 2)
+    warped_corners = annotation_source_slide.warp_xy_from_to(xy=corners, to_slide_obj=target_slide)
+    warped_corners = np.asarray(warped_corners).reshape(len(pixels["id"]), -1, 2)
+    warped_corners = np.concatenate([warped_corners, warped_corners[:, :1]], axis=1)
+
+# Save the centroids of the warped pixels with their corners
+with report.span("save"):
+    centroids = pixel_store.polygon_centroids(warped_corners)
+    pixel_store.write_pixels(warped_pixels_annotation_f,
+                             x=centroids[:, 0],
+                             y=centroids[:, 1],
+                             size=pixels["size"],
+                             ids=pixels["id"],
+                             corners=warped_corners)
+
+    # Save the warped pixels as a geojson file, that can be dragged and dropped into QuPath
+    if config["qupath_geojson"]:
+        pixel_store.write_geojson(f"{os.path.splitext(warped_pixels_annotation_f)[0]}.geojson", warped_corners)
 
-# Save annotation as warped_pixels in the form geojson file, that can be dragged and dropped into QuPath
-with open(warped_geojson_annotation_f, 'w') as f:
-    json.dump(warped_geojson, f)
+# Write the report of the stage
+report.write(f"{path}/results/reports/annotation_transfer.json")
@@ -0,0 +1,95 @@
+import os
+from collections import OrderedDict
+import numpy as np
+
+
+def nbytes(value) -> int:
+    """Get the memory held by an array or a dictionary of arrays (e.g. the MALDI pixels)
+
+    Args:
+        value (np.ndarray or dict): The array or the dictionary of arrays
+
+    Returns:
+        int: The number of bytes of the arrays
+    """
+    if isinstance(value, dict):
+        return sum(np.asarray(array).nbytes for array in value.values())
+
+    return np.asarray(value).nbytes
+
+
+def file_stat(file_f: str) -> tuple:
+    """Identify the version of a file by its size and modification time
+
+    Args:
+        file_f (str): Path to the file
+
+    Returns:
+        tuple: The size and the modification time in nanoseconds
+    """
+    stat = os.stat(file_f)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class ArrayCache:
+    """Bounded cache of the arrays decoded from files (e.g. images, masks, MALDI pixels), shared between the stages run in one process
+
+    An entry is valid as long as its file keeps the same size and modification time, so that a file
+    rewritten by another process is decoded again. The least recently used entries are evicted beyond
+    the memory budget, and the memory mapped arrays are not kept (their memory is not held by the cache).
+    """
+
+    def __init__(self, memory_budget: float):
+        """
+        Args:
+            memory_budget (float): Memory budget in MB of the cached arrays (0 to cache nothing)
+        """
+        self.max_bytes = memory_budget * 1024**2
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, file_f: str, load=None):
+        """Get the array decoded from a file, decoding and caching it if it is not cached
+
+        Args:
+            file_f (str): Path to the file
+            load (callable, optional): Function decoding the file (e.g. pixel_store.read_pixels). Defaults to None.
+
+        Returns:
+            The cached or decoded array (None if it is not cached and load is None)
+        """
+        path = os.path.abspath(file_f)
+        entry = self.entries.get(path)
+        if entry is not None and os.path.exists(path) and entry[0] == file_stat(path):
+            self.entries.move_to_end(path)
+            return entry[1]
+
+        if load is None:
+            return None
+
+        value = load(file_f)
+        self.put(file_f, value)
+        return value
+
+    def put(self, file_f: str, value) -> None:
+        """Cache the array of a file, e.g. right after the array was written to the file
+
+        Args:
+            file_f (str): Path to the file
+            value (np.ndarray or dict): The array or the dictionary of arrays
+        """
+        path = os.path.abspath(file_f)
+        if path in self.entries:
+            self.size -= self.entries.pop(path)[2]
+
+        size = nbytes(value)
+        if isinstance(value, np.memmap) or size > self.max_bytes:
+            return
+
+        self.entries[path] = (file_stat(path), value, size)
+        self.size += size
+
+        # Evict the least recently used entries
+        while self.size > self.max_bytes:
+            self.size -= self.entries.popitem(last=False)[1][2]
+
@@ -0,0 +1,471 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import numpy as np
+import tifffile
+import xgboost as xgb
+import yaml
+from PIL import Image
+
+import instrumentation
+import pixel_store
+
+# Directory of the pipeline scripts, run from the working directory of the benchmark
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+# Sizes of the synthetic inputs: image height and width, number of QuPath tiles, of spectra and of m/z values per spectrum
+PRESETS = {
+    "small": {"height": 2048, "width": 3072, "tiles": 4, "spectra": 2500, "mzs": 2000},
+    "medium": {"height": 8192, "width": 12288, "tiles": 8, "spectra": 20000, "mzs": 5000},
+    "large": {"height": 24576, "width": 32768, "tiles": 16, "spectra": 100000, "mzs": 10000},
+}
+
+# Markers of the synthetic slide: a QuPath annotation of the HES image and two XGBoost markers of one stain
+MARKERS = {"qupath_Lesion": "HES_Lesion",
+           "xgboost_CD8": "PANCKm-CD8r_CD8",
+           "xgboost_Tumor": "PANCKm-CD8r_Tumor"}
+
+# Relative tolerance of the comparison with the baselines (throughputs lower or peak memories higher are regressions)
+TOLERANCE = 0.2
+
+
+def image_tiles(height: int, width: int, seed: int, tile: int = 256):
+    """Generate the tiles of a synthetic RGB image: a light background with coloured blobs and noise
+
+    Args:
+        height (int): Height of the image
+        width (int): Width of the image
+        seed (int): Seed of the random generator
+        tile (int, optional): Size of the tiles. Defaults to 256.
+
+    Yields:
+        np.ndarray: The (tile, tile, 3) uint8 tiles in row-major order
+    """
+    rng = np.random.default_rng(seed)
+    for _ in range(0, height, tile):
+        for _ in range(0, width, tile):
+            chunk = np.full((tile, tile, 3), 220, dtype=np.int16)
+            for _ in range(rng.integers(2, 8)):
+                y, x, r = rng.integers(0, tile, 2).tolist() + [int(rng.integers(2, 24))]
+                chunk[max(0, y - r):y + r, max(0, x - r):x + r] = rng.integers(0, 256, 3)
+            chunk += rng.integers(-20, 20, chunk.shape, dtype=np.int16)
+            yield np.clip(chunk, 0, 255).astype(np.uint8)
+
+
+def write_image(image_f: str, height: int, width: int, seed: int) -> None:
+    """Write a synthetic RGB image as a tiled and compressed OME-TIFF, tile by tile
+
+    Args:
+        image_f (str): Path to the image (e.g. results/images_aligned/HES.ome.tiff)
+        height (int): Height of the image
+        width (int): Width of the image
+        seed (int): Seed of the random generator
+    """
+    tifffile.imwrite(image_f,
+                     image_tiles(height, width, seed),
+                     shape=(height, width, 3),
+                     dtype=np.uint8,
+                     tile=(256, 256),
+                     photometric="rgb",
+                     compression="zlib",
+                     bigtiff=True,
+                     ome=True)
+
+
+def write_qupath_tiles(path_qp: str, marker: str, height: int, width: int, num_of_tiles: int, seed: int) -> None:
+    """Write the <marker>_mask_i_of_N.png tiles of a synthetic QuPath export, with the annotations painted in green
+
+    Args:
+        path_qp (str): Path to the export directory of the QuPath project
+        marker (str): Name of the marker
+        height (int): Height of the image
+        width (int): Width of the image
+        num_of_tiles (int): Number of vertical tiles
+        seed (int): Seed of the random generator
+    """
+    rng = np.random.default_rng(seed)
+    bounds = np.linspace(0, width, num_of_tiles + 1).astype(int)
+    for i, (x0, x1) in enumerate(zip(bounds[:-1], bounds[1:]), start=1):
+        tile = np.full((height, x1 - x0, 3), 255, dtype=np.uint8)
+        for _ in range(rng.integers(1, 6)):
+            y, x = rng.integers(0, height), rng.integers(0, x1 - x0)
+            r = int(rng.integers(height // 50 + 1, height // 10 + 2))
+            tile[max(0, y - r):y + r, max(0, x - r):x + r, 1] = 10
+        Image.fromarray(tile).save(f"{path_qp}/{marker}_mask_{i}_of_{num_of_tiles}.png")
+
+
+def write_model(models_dir: str, name: str, seed: int) -> None:
+    """Train a tiny XGBoost booster on RGB colours and write it with its parameters
+
+    Args:
+        models_dir (str): Path to the models directory
+        name (str): Name of the marker of the model (e.g. CD8 for models/xgboost_CD8.model)
+        seed (int): Seed of the random generator
+    """
+    rng = np.random.default_rng(seed)
+    colours = rng.integers(0, 256, (20000, 3))
+    labels = colours[:, seed % 3] < 120
+    model = xgb.train({"max_depth": 4, "objective": "binary:logistic", "seed": seed},
+                      xgb.DMatrix(colours, label=labels),
+                      num_boost_round=10)
+    model.save_model(f"{models_dir}/xgboost_{name}.model")
+    with open(f"{models_dir}/xgboost_{name}.yaml", "w") as f:
+        yaml.safe_dump({"threshold": 0.5, "min_size": 30}, f)
+
+
+def grid_positions(num_of_spectra: int, height: int, width: int) -> np.ndarray:
+    """Lay out spectra on a regular grid with the aspect ratio of the image
+
+    Args:
+        num_of_spectra (int): Number of spectra
+        height (int): Height of the image
+        width (int): Width of the image
+
+    Returns:
+        np.ndarray: The (num_of_spectra, 2) 1-based x,y positions of the spectra
+    """
+    columns = int(np.ceil(np.sqrt(num_of_spectra * width / height)))
+    i = np.arange(num_of_spectra)
+    return np.stack([i % columns + 1, i // columns + 1], axis=1)
+
+
+def write_imzml(imzml_f: str, positions: np.ndarray, mzs: np.ndarray, seed: int, block_size: int = 1024) -> None:
+    """Write a synthetic continuous imzML/ibd pair, the spectra being Gaussian peaks on noise
+
+    Args:
+        imzml_f (str): Path to the imzML file (the ibd file is written next to it)
+        positions (np.ndarray): The (n_spectra, 2) 1-based x,y positions of the spectra
+        mzs (np.ndarray): The m/z values shared by all the spectra
+        seed (int): Seed of the random generator
+        block_size (int, optional): Number of spectra generated at once. Defaults to 1024.
+    """
+    rng = np.random.default_rng(seed)
+    ibd_f = f"{os.path.splitext(imzml_f)[0]}.ibd"
+    file_uuid = uuid.UUID(int=int(rng.integers(2**62)))
+    mzs = np.asarray(mzs, dtype=np.float32)
+    peaks = rng.choice(mzs, 20)
+    sha1 = hashlib.sha1()
+
+    # Binary data: the UUID, the m/z values once and the intensities of each spectrum
+    with open(ibd_f, "wb") as f:
+        for chunk in (file_uuid.bytes, mzs.tobytes()):
+            f.write(chunk)
+            sha1.update(chunk)
+        for start in range(0, len(positions), block_size):
+            n = min(block_size, len(positions) - start)
+            heights = rng.gamma(2, 50, (n, len(peaks)))
+            intensities = rng.exponential(5, (n, len(mzs)))
+            for peak, peak_heights in zip(peaks, heights.T):
+                intensities += peak_heights[:, np.newaxis] * np.exp(-0.5 * ((mzs - peak) / 0.05) ** 2)
+            chunk = intensities.astype(np.float32).tobytes()
+            f.write(chunk)
+            sha1.update(chunk)
+
+    length, encoded = len(mzs), len(mzs) * 4
+    offset = 16 + encoded
+    spectrum = ('<spectrum id="Scan={i}" defaultArrayLength="0" index="{index}">'
+                '<referenceableParamGroupRef ref="spectrum"/>'
+                '<scanList count="1"><cvParam cvRef="MS" accession="MS:1000795" name="no combination" value=""/>'
+                '<scan instrumentConfigurationRef="IC1">'
+                '<cvParam cvRef="IMS" accession="IMS:1000050" name="position x" value="{x}"/>'
+                '<cvParam cvRef="IMS" accession="IMS:1000051" name="position y" value="{y}"/>'
+                '</scan></scanList><binaryDataArrayList count="2">'
+                '<binaryDataArray encodedLength="0"><referenceableParamGroupRef ref="mzArray"/>'
+                f'<cvParam cvRef="IMS" accession="IMS:1000102" name="external offset" value="16"/>'
+                f'<cvParam cvRef="IMS" accession="IMS:1000103" name="external array length" value="{length}"/>'
+                f'<cvParam cvRef="IMS" accession="IMS:1000104" name="external encoded length" value="{encoded}"/>'
+                '<binary/></binaryDataArray>'
+                '<binaryDataArray encodedLength="0"><referenceableParamGroupRef ref="intensityArray"/>'
+                '<cvParam cvRef="IMS" accession="IMS:1000102" name="external offset" value="{offset}"/>'
+                f'<cvParam cvRef="IMS" accession="IMS:1000103" name="external array length" value="{length}"/>'
+                f'<cvParam cvRef="IMS" accession="IMS:1000104" name="external encoded length" value="{encoded}"/>'
+                '<binary/></binaryDataArray></binaryDataArrayList></spectrum>\n')
+    array = ('<referenceableParamGroup id="{id}">'
+             '<cvParam cvRef="MS" accession="{accession}" name="{name}" value=""/>'
+             '<cvParam cvRef="MS" accession="MS:1000521" name="32-bit float" value=""/>'
+             '<cvParam cvRef="MS" accession="MS:1000576" name="no compression" value=""/>'
+             '<cvParam cvRef="IMS" accession="IMS:1000101" name="external data" value="true"/>'
+             '</referenceableParamGroup>\n')
+
+    # Metadata of the spectra, referencing the binary data
+    with open(imzml_f, "w") as f:
+        f.write('<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+                '<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1">\n'
+                '<cvList count="3">'
+                '<cv id="MS" fullName="Proteomics Standards Initiative Mass Spectrometry Ontology" version="4.1.0" URI="http://purl.obolibrary.org/obo/ms.obo"/>'
+                '<cv id="UO" fullName="Unit Ontology" version="2020-03-10" URI="http://purl.obolibrary.org/obo/uo.obo"/>'
+                '<cv id="IMS" fullName="Imaging MS Ontology" version="1.1.0" URI="https://raw.githubusercontent.com/imzML/imzML/master/imagingMS.obo"/>'
+                '</cvList>\n'
+                '<fileDescription><fileContent>'
+                '<cvParam cvRef="MS" accession="MS:1000579" name="MS1 spectrum" value=""/>'
+                '<cvParam cvRef="IMS" accession="IMS:1000030" name="continuous" value=""/>'
+                f'<cvParam cvRef="IMS" accession="IMS:1000080" name="universally unique identifier" value="{{{file_uuid}}}"/>'
+                f'<cvParam cvRef="IMS" accession="IMS:1000091" name="ibd SHA-1" value="{sha1.hexdigest().upper()}"/>'
+                '</fileContent></fileDescription>\n'
+                '<referenceableParamGroupList count="3">\n'
+                + array.format(id="mzArray", accession="MS:1000514", name="m/z array")
+                + array.format(id="intensityArray", accession="MS:1000515", name="intensity array")
+                + '<referenceableParamGroup id="spectrum">'
+                '<cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="1"/>'
+                '<cvParam cvRef="MS" accession="MS:1000128" name="profile spectrum" value=""/>'
+                '<cvParam cvRef="MS" accession="MS:1000130" name="positive scan" value=""/>'
+                '</referenceableParamGroup>\n'
+                '</referenceableParamGroupList>\n'
+                '<softwareList count="1"><software id="benchmark" version="1.0">'
+                '<cvParam cvRef="MS" accession="MS:1000799" name="custom unreleased software tool" value="benchmark"/>'
+                '</software></softwareList>\n'
+                '<scanSettingsList count="1"><scanSettings id="scansettings1">'
+                f'<cvParam cvRef="IMS" accession="IMS:1000042" name="max count of pixels x" value="{positions[:, 0].max()}"/>'
+                f'<cvParam cvRef="IMS" accession="IMS:1000043" name="max count of pixels y" value="{positions[:, 1].max()}"/>'
+                '<cvParam cvRef="IMS" accession="IMS:1000046" name="pixel size x" value="50"/>'
+                '<cvParam cvRef="IMS" accession="IMS:1000047" name="pixel size y" value="50"/>'
+                '</scanSettings></scanSettingsList>\n'
+                '<instrumentConfigurationList count="1"><instrumentConfiguration id="IC1">'
+                '<cvParam cvRef="MS" accession="MS:1000031" name="instrument model" value=""/>'
+                '</instrumentConfiguration></instrumentConfigurationList>\n'
+                '<dataProcessingList count="1"><dataProcessing id="export">'
+                '<processingMethod order="0" softwareRef="benchmark">'
+                '<cvParam cvRef="MS" accession="MS:1000544" name="Conversion to mzML" value=""/>'
+                '</processingMethod></dataProcessing></dataProcessingList>\n'
+                '<run defaultInstrumentConfigurationRef="IC1" id="run">\n'
+                f'<spectrumList count="{len(positions)}" defaultDataProcessingRef="export">\n')
+        for index, (x, y) in enumerate(positions):
+            f.write(spectrum.format(i=index + 1, index=index, x=x, y=y, offset=offset + index * encoded))
+        f.write('</spectrumList>\n</run>\n</mzML>\n')
+
+
+def write_inputs(work_dir: str, lame: str, sizes: dict, seed: int = 0) -> dict:
+    """Generate the synthetic inputs of a slide in a working directory laid out like the pipeline data
+
+    Args:
+        work_dir (str): Path to the working directory
+        lame (str): Name of the synthetic slide
+        sizes (dict): Sizes of the inputs (see PRESETS)
+        seed (int, optional): Seed of the random generators. Defaults to 0.
+
+    Returns:
+        dict: The positions of the spectra, the imzML file and the warped MALDI pixels file
+    """
+    height, width = sizes["height"], sizes["width"]
+    path = f"{work_dir}/data/{lame}"
+    path_qp = f"{work_dir}/qp/{lame}/export"
+    for directory in (f"{path}/results/images_aligned", f"{path}/maldi", path_qp, f"{work_dir}/models"):
+        os.makedirs(directory, exist_ok=True)
+
+    # Aligned images of the stains and QuPath export of the annotations
+    for seed_offset, stain in enumerate(sorted({marker.split("_")[0] for marker in MARKERS.values()})):
+        write_image(f"{path}/results/images_aligned/{stain}.ome.tiff", height, width, seed + seed_offset)
+    for model, marker in MARKERS.items():
+        if model.startswith("qupath"):
+            write_qupath_tiles(path_qp, marker, height, width, sizes["tiles"], seed)
+        else:
+            write_model(f"{work_dir}/models", marker.split("_")[1], seed + len(marker))
+
+    # Spectra on a grid and their warped MALDI pixels covering the image
+    positions = grid_positions(sizes["spectra"], height, width)
+    imzml_f = f"{path}/maldi/mse.imzML"
+    write_imzml(imzml_f, positions, np.linspace(400, 1000, sizes["mzs"]), seed)
+
+    spacing = width / positions[:, 0].max()
+    x, y = (positions[:, 0] - 0.5) * spacing, (positions[:, 1] - 0.5) * spacing
+    pixels_f = f"{path}/results/pixels_maldi_warped.npz"
+    pixel_store.write_pixels(pixels_f, x=x, y=y, size=np.array([spacing, spacing]))
+
+    return {"positions": positions, "imzml_f": imzml_f, "pixels_f": pixels_f}
+
+
+def write_config(work_dir: str, lame: str, overrides: dict) -> None:
+    """Write the configuration of the synthetic slide from the configuration of the pipeline
+
+    Args:
+        work_dir (str): Path to the working directory
+        lame (str): Name of the synthetic slide
+        overrides (dict): Parameters replacing those of the pipeline configuration (e.g. {"lut": False})
+    """
+    with open(f"{REPO}/config.yaml", "r") as f:
+        config = yaml.safe_load(f)
+
+    config.update(lame=lame,
+                  path_to_data="data",
+                  path_to_qp_projects="qp",
+                  warped_annotation_file="pixels_maldi_warped.npz",
+                  markers=MARKERS,
+                  markers_microdissection={},
+                  instrumentation=True)
+    config.update(overrides)
+
+    with open(f"{work_dir}/config.yaml", "w") as f:
+        yaml.safe_dump(config, f)
+
+
+def run_stage(script: str, work_dir: str, lame: str) -> dict:
+    """Run a stage of the pipeline in its own process
+
+    Args:
+        script (str): Name of the script (e.g. mask_generation.py)
+        work_dir (str): Path to the working directory, the output being logged to <script>.log
+        lame (str): Name of the slide
+
+    Returns:
+        dict: The wall time and CPU time in seconds and the peak RSS in MB of the process
+    """
+    with open(f"{work_dir}/{os.path.splitext(script)[0]}.log", "w") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, f"{REPO}/{script}", lame], cwd=work_dir, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+
+    exit_code = os.waitstatus_to_exitcode(status)
+    if exit_code != 0:
+        raise RuntimeError(f"{script} failed with the exit code {exit_code}, see {log.name}")
+
+    return {"wall_s": wall, "cpu_s": usage.ru_utime + usage.ru_stime, "peak_rss_mb": usage.ru_maxrss / 1024}
+
+
+def run_benchmarks(work_dir: str, lame: str, sizes: dict, inputs: dict, names: list) -> dict:
+    """Time the hot paths of the pipeline on the synthetic inputs
+
+    The stages run end to end in their own process, the utils functions in the benchmark process.
+
+    Args:
+        work_dir (str): Path to the working directory
+        lame (str): Name of the synthetic slide
+        sizes (dict): Sizes of the inputs (see PRESETS)
+        inputs (dict): The synthetic inputs (see write_inputs)
+        names (list): Names of the benchmarks to run
+
+    Returns:
+        dict: The wall time, CPU time, peak RSS and throughput of each benchmark
+    """
+    results = {}
+    num_of_spectra = len(inputs["positions"])
+    report = instrumentation.Report("benchmark", lame)
+
+    if "mask_generation" in names:
+        results["mask_generation"] = run_stage("mask_generation.py", work_dir, lame)
+        results["mask_generation"]["pixels_per_s"] = sizes["height"] * sizes["width"] * len(MARKERS) / results["mask_generation"]["wall_s"]
+
+    if "mask_densities" in names:
+        results["mask_densities"] = run_stage("mask_densities.py", work_dir, lame)
+        results["mask_densities"]["spectra_per_s"] = num_of_spectra * len(MARKERS) / results["mask_densities"]["wall_s"]
+
+    # The utils functions are imported only when they are benchmarked, and skipped if their libraries are
+    # not installed (e.g. m2aia outside of its container), the results of the other benchmarks being kept
+    if "coord_to_geojson" in names:
+        from utils import coord_to_geojson
+        with report.span("coord_to_geojson") as record:
+            coord_to_geojson(inputs["positions"][:, 0].astype(float),
+                             inputs["positions"][:, 1].astype(float),
+                             save=True,
+                             name=f"{work_dir}/pixels",
+                             return_geojson=False)
+        results["coord_to_geojson"] = {"spectra_per_s": num_of_spectra / record["wall_s"]}
+
+    if "central_mz_feature" in names:
+        try:
+            import m2aia as m2
+        except ImportError as error:
+            print(f"Skipping central_mz_feature: {error}")
+        else:
+            from utils import central_mz_feature
+            with report.span("central_mz_feature") as record:
+                imzml = m2.ImzMLReader(inputs["imzml_f"])
+                central_mz_feature(imzml, inputs["positions"] - 1, center=700, tolerance=0.5)
+            results["central_mz_feature"] = {"spectra_per_s": num_of_spectra / record["wall_s"]}
+
+    for span in report.spans:
+        results[span["name"]].update(wall_s=span["wall_s"], cpu_s=span["cpu_s"], peak_rss_mb=span["peak_rss_mb"])
+
+    return results
+
+
+def compare(results: dict, baselines: dict, tolerance: float = TOLERANCE) -> list:
+    """Compare the results of the benchmarks with their baselines
+
+    Args:
+        results (dict): The results of the benchmarks (see run_benchmarks)
+        baselines (dict): The baselines of the benchmarks, with the same structure
+        tolerance (float, optional): Relative tolerance before a difference is a regression. Defaults to TOLERANCE.
+
+    Returns:
+        list: The regressions, as messages
+    """
+    regressions = []
+    for name, result in results.items():
+        baseline = baselines.get(name, {})
+        for metric, value in result.items():
+            if metric not in baseline:
+                print(f"{name}: {metric} = {value:.4g} (no baseline)")
+                continue
+            ratio = value / baseline[metric]
+            print(f"{name}: {metric} = {value:.4g} ({ratio:.2f} x baseline {baseline[metric]:.4g})")
+
+            # Throughputs should not decrease and peak memories should not increase
+            if metric.endswith("_per_s") and ratio < 1 - tolerance:
+                regressions.append(f"{name}: {metric} dropped to {ratio:.2f} x its baseline")
+            elif metric == "peak_rss_mb" and ratio > 1 + tolerance:
+                regressions.append(f"{name}: {metric} grew to {ratio:.2f} x its baseline")
+
+    return regressions
+
+
+if __name__ == "__main__":
+    benchmarks = ["mask_generation", "mask_densities", "coord_to_geojson", "central_mz_feature"]
+
+    parser = argparse.ArgumentParser(description="Benchmark the mask and density hot paths on synthetic inputs (CPU only)")
+    parser.add_argument("--preset", choices=PRESETS, default="small", help="Sizes of the synthetic inputs")
+    for size in PRESETS["small"]:
+        parser.add_argument(f"--{size}", type=int, help=f"Override the {size} of the preset")
+    parser.add_argument("--only", nargs="+", choices=benchmarks, default=benchmarks, help="Benchmarks to run")
+    parser.add_argument("--set", nargs="+", default=[], metavar="KEY=VALUE", help="Override config.yaml parameters (e.g. lut=False)")
+    parser.add_argument("--baselines", default=f"{REPO}/benchmark_baselines.json", help="JSON file of the stored baselines")
+    parser.add_argument("--update-baselines", action="store_true", help="Store the results as the baselines of this configuration")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="Relative tolerance of the comparison with the baselines")
+    parser.add_argument("--work-dir", help="Working directory of the synthetic slide, kept after the run (temporary if not given)")
+    args = parser.parse_args()
+
+    sizes = {size: getattr(args, size) or value for size, value in PRESETS[args.preset].items()}
+    overrides = dict(item.split("=", 1) for item in args.set)
+    overrides = {key: yaml.safe_load(value) for key, value in overrides.items()}
+
+    # The baselines are stored per preset and overrides, the results depending on both
+    configuration = " ".join([args.preset]
+                             + [f"{size}={value}" for size, value in sizes.items() if value != PRESETS[args.preset][size]]
+                             + [f"{key}={value}" for key, value in sorted(overrides.items())])
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="benchmark_")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        print(f"Generating the synthetic inputs ({configuration}) in {work_dir}")
+        inputs = write_inputs(work_dir, "synthetic", sizes)
+        write_config(work_dir, "synthetic", overrides)
+
+        print(f"Running {', '.join(args.only)}")
+        results = run_benchmarks(work_dir, "synthetic", sizes, inputs, args.only)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    # Compare the results with the stored baselines of the configuration
+    stored = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines, "r") as f:
+            stored = json.load(f)
+    regressions = compare(results, stored.get(configuration, {}), args.tolerance)
+
+    if args.update_baselines:
+        stored.setdefault(configuration, {}).update(results)
+        with open(args.baselines, "w") as f:
+            json.dump(stored, f, indent=4)
+        print(f"Baselines of {configuration} stored in {args.baselines}")
+
+    if regressions:
+        print("Regressions:\n" + "\n".join(regressions))
+        sys.exit(1)
@@ -0,0 +1,225 @@
+import os
+import numpy as np
+
+import hashing
+import image_tiles
+import mask_store
+
+# Approximate number of bytes held in memory per mask pixel of a band:
+# the boolean rows and their int64 summed-area table
+BYTES_PER_PIXEL = 1 + 8
+
+# Approximate number of bytes held in memory per mask pixel of a band with the polygon densities:
+# the boolean rows, the uint32 labels and the labels selected by the mask
+LABEL_BYTES_PER_PIXEL = 1 + 4 + 4
+
+
+def summed_area_table(band: np.ndarray) -> np.ndarray:
+    """Compute the summed-area table (integral image) of a boolean band
+
+    Args:
+        band (np.ndarray): The (rows, columns) boolean band
+
+    Returns:
+        np.ndarray: The (rows + 1, columns + 1) int64 table, table[i, j] being the sum of band[:i, :j]
+    """
+    table = np.zeros((band.shape[0] + 1, band.shape[1] + 1), dtype=np.int64)
+    np.cumsum(band, axis=0, dtype=np.int64, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+
+    return table
+
+
+def window_half_length(maldi_pixel_length: float, image_pixel_length: float) -> int:
+    """Compute the half length of the square window of a MALDI pixel in image pixels
+
+    Args:
+        maldi_pixel_length (float): Pixel length of the MALDI images in micrometers
+        image_pixel_length (float): Pixel length of the images in micrometers
+
+    Returns:
+        int: Half length l of the windows
+    """
+    return int((maldi_pixel_length / image_pixel_length) / 2)
+
+
+def band_densities(read_rows, height: int, width: int, x: np.ndarray, y: np.ndarray, half_length: int, memory_budget: float = 1024) -> np.ndarray:
+    """Compute the density of a mask in the square windows around the MALDI pixel centroids
+
+    The density of a centroid (x, y) is the mean of mask[int(y)-l:int(y)+l, int(x)-l:int(x)+l],
+    the windows crossing the image border being clipped to the image (NaN if nothing is left).
+    The mask is read in bands of rows with a halo of 2l rows, a summed-area table is built
+    once per band and the sums of all the windows starting in the band are looked up at once.
+
+    Args:
+        read_rows (callable): Function returning the (y1 - y0, width) boolean rows y0 to y1 of the mask
+        height (int): Height of the mask
+        width (int): Width of the mask
+        x (np.ndarray): x coordinates of the centroids in the mask pixels
+        y (np.ndarray): y coordinates of the centroids in the mask pixels
+        half_length (int): Half length l of the square windows in the mask pixels
+        memory_budget (float, optional): Memory budget in MB for a band and its summed-area table. Defaults to 1024.
+
+    Returns:
+        np.ndarray: The float64 density of each centroid
+    """
+    # Clip the windows to the image
+    x, y = np.trunc(np.asarray(x)).astype(np.int64), np.trunc(np.asarray(y)).astype(np.int64)
+    x0, x1 = np.clip(x - half_length, 0, width), np.clip(x + half_length, 0, width)
+    y0, y1 = np.clip(y - half_length, 0, height), np.clip(y + half_length, 0, height)
+    counts = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+
+    # Height of the bands so that the band, its halo and its table fit in the budget
+    rows = max(1, image_tiles.band_height(width=width, memory_budget=memory_budget, bytes_per_pixel=BYTES_PER_PIXEL) - 2 * half_length)
+
+    sums = np.zeros(len(x), dtype=np.int64)
+    for b0 in range(0, height, rows):
+        # Select the non-empty windows starting in the band
+        selected = np.flatnonzero((y0 >= b0) & (y0 < b0 + rows) & (counts > 0))
+        if len(selected) == 0:
+            continue
+
+        # Build the summed-area table of the band and its halo
+        b1 = min(height, b0 + rows + 2 * half_length)
+        table = summed_area_table(read_rows(b0, b1))
+
+        # Look up the sums of the windows
+        ya, yb, xa, xb = y0[selected] - b0, y1[selected] - b0, x0[selected], x1[selected]
+        sums[selected] = table[yb, xb] - table[ya, xb] - table[yb, xa] + table[ya, xa]
+        del table
+
+    # Divide by the number of pixels of the windows
+    densities = np.full(len(x), np.nan)
+    np.divide(sums, counts, out=densities, where=counts > 0)
+
+    return densities
+
+
+def label_densities(read_rows, labels_f: str, num_of_pixels: int, memory_budget: float = 1024) -> np.ndarray:
+    """Compute the density of a mask in the warped polygons of the MALDI pixels
+
+    The polygons are given by a label image rasterised once (see pixel_labels), the density
+    of a MALDI pixel being the fraction of the mask pixels labelled with it that are in the mask.
+    The mask and the labels are read in bands and all the pixels are reduced at once with
+    np.bincount, so the cost depends on the image size and not on the number of MALDI pixels.
+
+    Args:
+        read_rows (callable): Function returning the (y1 - y0, width) boolean rows y0 to y1 of the mask
+        labels_f (str): Path to the label image of the MALDI pixels, of the same shape as the mask
+        num_of_pixels (int): Number of MALDI pixels
+        memory_budget (float, optional): Memory budget in MB for a band of the mask and its labels. Defaults to 1024.
+
+    Returns:
+        np.ndarray: The float64 density of each MALDI pixel (NaN if its polygon covers no mask pixel)
+    """
+    height, width, _ = image_tiles.image_shape(labels_f)
+    rows = image_tiles.band_height(width=width, memory_budget=memory_budget, bytes_per_pixel=LABEL_BYTES_PER_PIXEL,
+                                   multiple=image_tiles.segment_height(labels_f))
+
+    # Count the mask pixels of each polygon and those in the mask
+    areas = np.zeros(num_of_pixels + 1, dtype=np.int64)
+    sums = np.zeros(num_of_pixels + 1, dtype=np.int64)
+    for y, labels in image_tiles.iter_bands(labels_f, rows):
+        labels = labels[..., 0]
+        areas += np.bincount(labels.ravel(), minlength=num_of_pixels + 1)
+        sums += np.bincount(labels[read_rows(y, y + labels.shape[0])], minlength=num_of_pixels + 1)
+        del labels
+
+    # Divide by the number of mask pixels of the polygons, the label 0 being outside the polygons
+    densities = np.full(num_of_pixels, np.nan)
+    np.divide(sums[1:], areas[1:], out=densities, where=areas[1:] > 0)
+
+    return densities
+
+
+def window_densities(mask_f: str, x: np.ndarray, y: np.ndarray, half_length: int, memory_budget: float = 1024, labels_f: str = None) -> np.ndarray:
+    """Compute the density of a saved mask around the MALDI pixel centroids
+
+    The densities are computed in the square windows (see band_densities),
+    or in the warped polygons of the pixels if their label image is given (see label_densities).
+
+    Args:
+        mask_f (str): Path to the mask file (see mask_store)
+        x (np.ndarray): x coordinates of the centroids in the mask pixels
+        y (np.ndarray): y coordinates of the centroids in the mask pixels
+        half_length (int): Half length l of the square windows in the mask pixels
+        memory_budget (float, optional): Memory budget in MB for a band and its summed-area table. Defaults to 1024.
+        labels_f (str, optional): Path to the label image of the MALDI pixels (square windows if None). Defaults to None.
+
+    Returns:
+        np.ndarray: The float64 density of each centroid
+    """
+    height, width = mask_store.mask_shape(mask_f)
+    read_rows = lambda y0, y1: mask_store.read_mask(mask_f, window=(y0, y1, 0, width))
+
+    if labels_f is not None:
+        return label_densities(read_rows, labels_f, len(x), memory_budget)
+
+    return band_densities(read_rows, height, width, x, y, half_length, memory_budget)
+
+
+def array_densities(mask: np.ndarray, x: np.ndarray, y: np.ndarray, half_length: int, memory_budget: float = 1024, labels_f: str = None) -> np.ndarray:
+    """Compute the density of a mask held in memory (or memory mapped) around the MALDI pixel centroids (see window_densities)
+
+    Args:
+        mask (np.ndarray): The (height, width) boolean mask
+        x (np.ndarray): x coordinates of the centroids in the mask pixels
+        y (np.ndarray): y coordinates of the centroids in the mask pixels
+        half_length (int): Half length l of the square windows in the mask pixels
+        memory_budget (float, optional): Memory budget in MB for a band and its summed-area table. Defaults to 1024.
+        labels_f (str, optional): Path to the label image of the MALDI pixels (square windows if None). Defaults to None.
+
+    Returns:
+        np.ndarray: The float64 density of each centroid
+    """
+    read_rows = lambda y0, y1: np.asarray(mask[y0:y1])
+
+    if labels_f is not None:
+        return label_densities(read_rows, labels_f, len(x), memory_budget)
+
+    return band_densities(read_rows, *mask.shape, x, y, half_length, memory_budget)
+
+
+def densities_key(pixels_f: str, half_length: int, mode: str = "window") -> str:
+    """Identify the densities of a mask by the MALDI pixels and the windows they were computed with
+
+    Args:
+        pixels_f (str): Path to the warped MALDI pixels (see pixel_store)
+        half_length (int): Half length l of the square windows in the mask pixels
+        mode (str, optional): Shape of the windows, window for the squares or polygon for the warped polygons. Defaults to "window".
+
+    Returns:
+        str: Hexadecimal hash of the pixels file content, the half length and the mode
+    """
+    return hashing.params_hash({"pixels": hashing.file_hash(pixels_f), "half_length": half_length, "mode": mode})
+
+
+def write_densities(density_f: str, values: np.ndarray, key: str) -> None:
+    """Save the densities of a mask at the MALDI pixels, so that the mask itself does not need to be saved
+
+    Args:
+        density_f (str): Path to the densities file (e.g. results/masks/<marker>_density.npz)
+        values (np.ndarray): The density of each MALDI pixel
+        key (str): Key of the pixels and windows the densities were computed with (see densities_key)
+    """
+    np.savez(f"{density_f}.tmp.npz", key=key, density=values)
+    os.replace(f"{density_f}.tmp.npz", density_f)
+
+
+def read_densities(density_f: str, key: str) -> np.ndarray:
+    """Read the densities saved by write_densities
+
+    Args:
+        density_f (str): Path to the densities file
+        key (str): Key of the pixels and windows the densities should have been computed with (see densities_key)
+
+    Returns:
+        np.ndarray: The density of each MALDI pixel (None if the file does not exist or has another key)
+    """
+    if not os.path.exists(density_f):
+        return None
+
+    with np.load(density_f) as saved:
+        if str(saved["key"]) != key:
+            return None
+        return saved["density"]
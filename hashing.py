@@ -0,0 +1,32 @@
+import hashlib
+import json
+
+
+def file_hash(file_f: str, chunk_size: int = 2**24) -> str:
+    """Compute the SHA-256 hash of the content of a file
+
+    Args:
+        file_f (str): Path to the file
+        chunk_size (int, optional): Number of bytes read at once. Defaults to 2**24.
+
+    Returns:
+        str: Hexadecimal digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(file_f, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def params_hash(params) -> str:
+    """Compute the SHA-256 hash of JSON serializable parameters
+
+    Args:
+        params: Parameters (e.g. a dictionary of options and file hashes), the keys order does not matter
+
+    Returns:
+        str: Hexadecimal digest of the parameters
+    """
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
@@ -0,0 +1,163 @@
+import numpy as np
+import tifffile
+
+# Approximate number of bytes held in memory per pixel while a band is predicted:
+# the RGB values (3 x uint8), their float32 copy in the DMatrix (3 x float32),
+# the float32 predictions and the boolean mask
+BYTES_PER_PIXEL = 3 + 3 * 4 + 4 + 1
+
+
+def level_page(tif: tifffile.TiffFile, level: int = 0) -> tifffile.TiffPage:
+    """Get the page of a resolution level of an opened TIFF image
+
+    Args:
+        tif (tifffile.TiffFile): The opened TIFF image
+        level (int, optional): Resolution level, 0 being the full resolution. Defaults to 0.
+
+    Returns:
+        tifffile.TiffPage: The first page of the level (from the OME pyramid or the SubIFDs of the first page)
+    """
+    levels = tif.series[0].levels
+    if level < len(levels):
+        return levels[level].keyframe
+
+    return tif.pages[0].pages[level - 1]
+
+
+def image_shape(image_f: str, level: int = 0) -> tuple:
+    """Get the shape of a resolution level of a (OME-)TIFF image without reading it
+
+    Args:
+        image_f (str): Path to the TIFF image
+        level (int, optional): Resolution level, 0 being the full resolution. Defaults to 0.
+
+    Returns:
+        tuple: The (height, width, samples) shape of the level
+    """
+    with tifffile.TiffFile(image_f) as tif:
+        page = level_page(tif, level)
+        return page.imagelength, page.imagewidth, page.samplesperpixel
+
+
+def segment_height(image_f: str) -> int:
+    """Get the height of the tiles or strips in which the TIFF image is stored
+
+    Args:
+        image_f (str): Path to the TIFF image
+
+    Returns:
+        int: Number of rows of a tile (or a strip) of the full resolution level
+    """
+    with tifffile.TiffFile(image_f) as tif:
+        page = tif.series[0].keyframe
+        return page.tilelength if page.is_tiled else min(page.rowsperstrip, page.imagelength)
+
+
+def band_height(width: int, memory_budget: float, bytes_per_pixel: int = BYTES_PER_PIXEL, multiple: int = 1) -> int:
+    """Compute the number of rows of the bands that fit in the memory budget
+
+    Args:
+        width (int): Width of the image in pixels
+        memory_budget (float): Memory budget in MB for a single band
+        bytes_per_pixel (int, optional): Bytes held in memory per pixel of the band. Defaults to BYTES_PER_PIXEL.
+        multiple (int, optional): The band height is rounded down to a multiple of this value (e.g. the tile height). Defaults to 1.
+
+    Returns:
+        int: Height of the bands, at least one multiple
+    """
+    # Number of rows that fit in the budget
+    rows = int(memory_budget * 1024**2) // (width * bytes_per_pixel)
+
+    # Round down to the multiple without going below a single one
+    return max(multiple, rows // multiple * multiple)
+
+
+def read_page_window(tif: tifffile.TiffFile, page: tifffile.TiffPage, y0: int, y1: int, x0: int, x1: int) -> np.ndarray:
+    """Read a window of a page by decoding only the tiles (or strips) overlapping it
+
+    Args:
+        tif (tifffile.TiffFile): The opened TIFF image
+        page (tifffile.TiffPage): The page to read
+        y0 (int): First row of the window
+        y1 (int): Row after the last row of the window
+        x0 (int): First column of the window
+        x1 (int): Column after the last column of the window
+
+    Returns:
+        np.ndarray: The (rows, columns, samples) window
+    """
+    image_height, image_width = page.imagelength, page.imagewidth
+    y1, x1 = min(y1, image_height), min(x1, image_width)
+    window = np.empty((y1 - y0, x1 - x0, page.samplesperpixel), dtype=page.dtype)
+
+    # Size of the segments (tiles or strips) on the grid of the image
+    if page.is_tiled:
+        seg_height, seg_width = page.tilelength, page.tilewidth
+    else:
+        seg_height, seg_width = min(page.rowsperstrip, image_height), image_width
+    segs_across = -(-image_width // seg_width)
+    segs_down = -(-image_height // seg_height)
+
+    # Row and column of the grid of each segment (the planes of separate samples repeat the grid)
+    indices = np.arange(len(page.dataoffsets))
+    seg_rows = (indices // segs_across) % segs_down
+    seg_cols = indices % segs_across
+
+    # Select the segments overlapping the window
+    indices = indices[(seg_rows * seg_height < y1) & ((seg_rows + 1) * seg_height > y0) &
+                      (seg_cols * seg_width < x1) & ((seg_cols + 1) * seg_width > x0)]
+
+    # Read and decode the selected segments
+    for data, index in tif.filehandle.read_segments([page.dataoffsets[i] for i in indices],
+                                                    [page.databytecounts[i] for i in indices],
+                                                    indices=indices.tolist(),
+                                                    sort=True):
+        segment, (s, _, sy, sx, _), _ = page.decode(data, index,
+                                                    jpegtables=page.jpegtables,
+                                                    jpegheader=page.jpegheader)
+        segment = segment[0]
+
+        # Crop the segment to the window (edge tiles are padded beyond the image)
+        top, bottom = max(sy, y0), min(sy + seg_height, y1)
+        left, right = max(sx, x0), min(sx + seg_width, x1)
+        window[top - y0:bottom - y0, left - x0:right - x0, s:s + segment.shape[-1]] = segment[top - sy:bottom - sy, left - sx:right - sx]
+
+    return window
+
+
+def read_window(image_f: str, y0: int, y1: int, x0: int, x1: int, level: int = 0) -> np.ndarray:
+    """Read a window of a (OME-)TIFF image without loading the whole image
+
+    Args:
+        image_f (str): Path to the TIFF image
+        y0 (int): First row of the window
+        y1 (int): Row after the last row of the window
+        x0 (int): First column of the window
+        x1 (int): Column after the last column of the window
+        level (int, optional): Resolution level, 0 being the full resolution. Defaults to 0.
+
+    Returns:
+        np.ndarray: The (rows, columns, samples) window
+    """
+    with tifffile.TiffFile(image_f) as tif:
+        return read_page_window(tif, level_page(tif, level), y0, y1, x0, x1)
+
+
+def iter_bands(image_f: str, height: int, level: int = 0):
+    """Read a (OME-)TIFF image as horizontal bands without loading the whole image
+
+    Only the tiles (or strips) overlapping a band are read and decoded from the disk,
+    so the memory used is bounded by the band size and not by the image size.
+
+    Args:
+        image_f (str): Path to the TIFF image
+        height (int): Number of rows of each band (the last band may be shorter)
+        level (int, optional): Resolution level, 0 being the full resolution. Defaults to 0.
+
+    Yields:
+        tuple: The first row of the band and the band as a (rows, width, samples) array
+    """
+    with tifffile.TiffFile(image_f) as tif:
+        page = level_page(tif, level)
+        for y in range(0, page.imagelength, height):
+            yield y, read_page_window(tif, page, y, y + height, 0, page.imagewidth)
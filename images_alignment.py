@@ -1,14 +1,21 @@
 from valis import registration
 import yaml
+import sys
+
+from registration_cache import get_registrar
+import instrumentation
 
 # Load the configuration file
 with open("config.yaml", "r") as file:
     config = yaml.load(file, Loader=yaml.FullLoader)
 
 # Hyperparameters
-lame = config["lame"]  # Name of the lame
+lame = sys.argv[1] if len(sys.argv) > 1 else config["lame"]  # Name of the lame (given by Snakemake or from the config)
 path = f"{config['path_to_data']}/{lame}"  # Path to the data
 
+# Record the time, memory and I/O of the registration and the warping if enabled
+report = instrumentation.Report("images_alignment", lame, config["instrumentation"])
+
 
 # Images directory to be aligned including the reference
 slide_src_dir = f"{path}/images/alignment"
@@ -19,18 +26,21 @@ registered_slide_dst_dir = f"{path}/results/images_aligned"
 # The reference image to which all the images will be aligned
 reference_slide = config["reference_slide"]
 
-# Create a Valis object and use it to register the slides in slide_src_dir
-registrar = registration.Valis(src_dir=slide_src_dir,
-                               dst_dir=results_dst_dir,
-                               reference_img_f=reference_slide,
-                               align_to_reference=config["align_to_reference"])
-
-# Apply the alignment on the slides in slide_src_dir
-rigid_registrar, non_rigid_registrar, error_df = registrar.register()
+# Register the slides in slide_src_dir, or load their registration from the cache
+with report.span("registration"):
+    registrar = get_registrar(src_dir=slide_src_dir,
+                              dst_dir=results_dst_dir,
+                              reference_img_f=reference_slide,
+                              align_to_reference=config["align_to_reference"],
+                              cache_dir=f"{path}/results/registration" if config["registration_cache"] else None)
 
 # Save all registered slides as ome.tiff
-registrar.warp_and_save_slides(registered_slide_dst_dir,
-                               crop=config["crop"])
+with report.span("warp and save"):
+    registrar.warp_and_save_slides(registered_slide_dst_dir,
+                                   crop=config["crop"])
 
 # Kill the JVM
-registration.kill_jvm()
\ No newline at end of file
+registration.kill_jvm()
+
+# Write the report of the stage
+report.write(f"{path}/results/reports/images_alignment.json")
@@ -0,0 +1,342 @@
+import os
+import time
+import ctypes
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import xgboost as xgb
+
+import hashing
+
+# Number of colours of 8-bit RGB images
+NUM_OF_COLOURS = 2**24
+
+# Value of the probability 1 once quantised to uint8
+PROBABILITY_SCALE = 255
+
+
+def cuda_devices() -> int:
+    """Count the CUDA devices visible to the process through the CUDA driver
+
+    Returns:
+        int: Number of visible GPUs (0 if the driver is missing or no GPU is found)
+    """
+    # Load the CUDA driver library (only bound inside the containers started with --nv)
+    try:
+        cuda = ctypes.CDLL("libcuda.so.1")
+    except OSError:
+        return 0
+
+    # Initialize the driver and count the devices
+    count = ctypes.c_int()
+    if cuda.cuInit(0) != 0 or cuda.cuDeviceGetCount(ctypes.byref(count)) != 0:
+        return 0
+
+    return count.value
+
+
+def select_device(device: str = "auto") -> str:
+    """Select the device on which the XGBoost models are run
+
+    Args:
+        device (str, optional): Requested device ("auto", "cpu", "cuda" or "gpu"). Defaults to "auto".
+
+    Returns:
+        str: "cuda" if requested or if XGBoost is built with CUDA and a GPU is visible, otherwise "cpu"
+    """
+    if device != "auto":
+        return "cuda" if device == "gpu" else device
+
+    # Use the GPU only if XGBoost can use it
+    if xgb.build_info().get("USE_CUDA", False) and cuda_devices() > 0:
+        return "cuda"
+
+    return "cpu"
+
+
+def configure_model(model: xgb.Booster, device: str = "auto", workers: int = 0, nthread: int = 0) -> int:
+    """Set the device and threads of the model and compute the number of concurrent workers
+
+    On GPU a single worker feeds the device. On CPU the cores are shared between
+    the workers, each worker running XGBoost with nthread threads.
+
+    Args:
+        model (xgb.Booster): The XGBoost model
+        device (str, optional): Requested device, see select_device. Defaults to "auto".
+        workers (int, optional): Number of tiles predicted concurrently on CPU (0: all the cores divided by nthread). Defaults to 0.
+        nthread (int, optional): Number of XGBoost threads per worker on CPU (0: all the cores divided by workers). Defaults to 0.
+
+    Returns:
+        int: Number of workers to use with predict_masks
+    """
+    # Select the device
+    device = select_device(device)
+
+    if device == "cpu":
+        # Cores granted to the job (e.g. the threads of the Snakemake rule) or all the cores
+        cores = int(os.environ.get("OMP_NUM_THREADS", 0)) or os.cpu_count() or 1
+        # Split the cores between the workers and their threads
+        if workers <= 0:
+            workers = max(1, cores // nthread) if nthread > 0 else cores
+        if nthread <= 0:
+            nthread = max(1, cores // workers)
+    else:
+        workers = 1
+
+    model.set_param({"device": device, "nthread": nthread})
+    print(f"Running the model on {device} with {workers} worker(s) of {nthread or 'all'} thread(s)")
+
+    return workers
+
+
+def predict_mask(model: xgb.Booster, threshold: float, tile: np.ndarray) -> np.ndarray:
+    """Predict the boolean mask of an RGB image tile
+
+    Args:
+        model (xgb.Booster): The XGBoost model taking the RGB values of a pixel as features
+        threshold (float): Probability above which a pixel belongs to the mask
+        tile (np.ndarray): The (rows, columns, 3) image tile
+
+    Returns:
+        np.ndarray: The (rows, columns) boolean mask
+    """
+    # Predict directly from the array (thread safe and without building a DMatrix)
+    preds = model.inplace_predict(tile.reshape(-1, tile.shape[-1]))
+
+    return preds.reshape(tile.shape[:2]) > threshold
+
+
+def quantise(preds: np.ndarray) -> np.ndarray:
+    """Quantise probabilities to uint8, 0 to PROBABILITY_SCALE
+
+    Args:
+        preds (np.ndarray): The float probabilities
+
+    Returns:
+        np.ndarray: The uint8 quantised probabilities
+    """
+    return np.rint(preds * PROBABILITY_SCALE).astype(np.uint8)
+
+
+def predict_probabilities(model: xgb.Booster, tile: np.ndarray) -> np.ndarray:
+    """Predict the quantised probabilities of an RGB image tile
+
+    Args:
+        model (xgb.Booster): The XGBoost model taking the RGB values of a pixel as features
+        tile (np.ndarray): The (rows, columns, 3) image tile
+
+    Returns:
+        np.ndarray: The (rows, columns) uint8 quantised probabilities
+    """
+    preds = model.inplace_predict(tile.reshape(-1, tile.shape[-1]))
+
+    return quantise(preds).reshape(tile.shape[:2])
+
+
+def threshold_probabilities(probs: np.ndarray, threshold: float) -> np.ndarray:
+    """Threshold quantised probabilities, up to the half quantum of the quantisation
+
+    Args:
+        probs (np.ndarray): The uint8 quantised probabilities
+        threshold (float): Probability above which a pixel belongs to the mask
+
+    Returns:
+        np.ndarray: The boolean mask
+    """
+    return probs > threshold * PROBABILITY_SCALE
+
+
+def colour_codes(tile: np.ndarray) -> np.ndarray:
+    """Encode the 8-bit RGB values of the pixels as single integers (the index in the colour cube)
+
+    Args:
+        tile (np.ndarray): The (rows, columns, 3) uint8 image tile
+
+    Returns:
+        np.ndarray: The (rows, columns) uint32 colour codes
+    """
+    return (tile[..., 0].astype(np.uint32) << 16) | (tile[..., 1].astype(np.uint32) << 8) | tile[..., 2]
+
+
+def cube_colours(start: int, stop: int) -> np.ndarray:
+    """Decode a range of colour codes into the RGB values of the colour cube
+
+    Args:
+        start (int): First colour code
+        stop (int): Colour code after the last one
+
+    Returns:
+        np.ndarray: The (stop - start, 3) uint8 RGB values
+    """
+    codes = np.arange(start, stop, dtype=np.uint32)
+
+    return np.stack([codes >> 16, (codes >> 8) & 255, codes & 255], axis=1).astype(np.uint8)
+
+
+def colour_lut(model: xgb.Booster, model_f: str, threshold: float, chunk_size: int = 2**20) -> np.ndarray:
+    """Get the thresholded prediction of the model for every 8-bit RGB colour
+
+    The model only sees the RGB values of a pixel, so its mask is a function of the colour.
+    The lookup table is computed once over the colour cube and cached next to the model
+    as a bit-packed file, invalidated when the model file or the threshold changes.
+
+    Args:
+        model (xgb.Booster): The XGBoost model taking the RGB values of a pixel as features
+        model_f (str): Path to the model file, the cache is saved as <model>.lut.npz
+        threshold (float): Probability above which a pixel belongs to the mask
+        chunk_size (int, optional): Number of colours predicted at once. Defaults to 2**20.
+
+    Returns:
+        np.ndarray: Boolean lookup table of NUM_OF_COLOURS values indexed by colour_codes
+    """
+    # Identify the model and threshold
+    lut_f = f"{os.path.splitext(model_f)[0]}.lut.npz"
+    key = hashing.params_hash({"model": hashing.file_hash(model_f), "threshold": threshold})
+
+    # Load the cached lookup table if it was computed with the same model and threshold
+    if os.path.exists(lut_f):
+        with np.load(lut_f) as cached:
+            if str(cached["key"]) == key:
+                print(f"Loading the colour lookup table {lut_f}")
+                return np.unpackbits(cached["lut"]).view(bool)
+
+    # Predict the colour cube chunk by chunk
+    print(f"Computing the colour lookup table {lut_f}")
+    lut = np.empty(NUM_OF_COLOURS, dtype=bool)
+    for start in range(0, NUM_OF_COLOURS, chunk_size):
+        lut[start:start + chunk_size] = model.inplace_predict(cube_colours(start, start + chunk_size)) > threshold
+
+    # Cache the lookup table as bits, written to a temporary file of the process and renamed once complete,
+    # so that the slides processed concurrently never read a partially written table
+    np.savez(f"{lut_f}.{os.getpid()}.tmp.npz", key=key, lut=np.packbits(lut))
+    os.replace(f"{lut_f}.{os.getpid()}.tmp.npz", lut_f)
+
+    return lut
+
+
+def probability_lut(model: xgb.Booster, model_f: str, chunk_size: int = 2**20) -> np.ndarray:
+    """Get the quantised probability of the model for every 8-bit RGB colour
+
+    As colour_lut without the threshold, the lookup table being cached next to the model
+    and invalidated when the model file changes.
+
+    Args:
+        model (xgb.Booster): The XGBoost model taking the RGB values of a pixel as features
+        model_f (str): Path to the model file, the cache is saved as <model>.probabilities.npz
+        chunk_size (int, optional): Number of colours predicted at once. Defaults to 2**20.
+
+    Returns:
+        np.ndarray: uint8 lookup table of NUM_OF_COLOURS quantised probabilities indexed by colour_codes
+    """
+    # Identify the model
+    lut_f = f"{os.path.splitext(model_f)[0]}.probabilities.npz"
+    key = hashing.file_hash(model_f)
+
+    # Load the cached lookup table if it was computed with the same model
+    if os.path.exists(lut_f):
+        with np.load(lut_f) as cached:
+            if str(cached["key"]) == key:
+                print(f"Loading the probability lookup table {lut_f}")
+                return cached["lut"]
+
+    # Predict the colour cube chunk by chunk
+    print(f"Computing the probability lookup table {lut_f}")
+    lut = np.empty(NUM_OF_COLOURS, dtype=np.uint8)
+    for start in range(0, NUM_OF_COLOURS, chunk_size):
+        lut[start:start + chunk_size] = quantise(model.inplace_predict(cube_colours(start, start + chunk_size)))
+
+    # Cache the lookup table, renamed once complete as in colour_lut
+    np.savez(f"{lut_f}.{os.getpid()}.tmp.npz", key=key, lut=lut)
+    os.replace(f"{lut_f}.{os.getpid()}.tmp.npz", lut_f)
+
+    return lut
+
+
+def lut_mask(lut: np.ndarray, tile: np.ndarray) -> np.ndarray:
+    """Predict the boolean mask of an RGB image tile with a colour lookup table
+
+    Args:
+        lut (np.ndarray): Boolean lookup table computed by colour_lut (or uint8 one computed by probability_lut)
+        tile (np.ndarray): The (rows, columns, 3) uint8 image tile
+
+    Returns:
+        np.ndarray: The (rows, columns) boolean mask (or uint8 quantised probabilities)
+    """
+    return lut[colour_codes(tile)]
+
+
+def lut_masks(luts: list, tile: np.ndarray) -> list:
+    """Predict the masks of several markers of an RGB image tile with their colour lookup tables
+
+    The colour codes of the tile are computed once for all the lookup tables.
+
+    Args:
+        luts (list): Lookup tables computed by colour_lut or probability_lut
+        tile (np.ndarray): The (rows, columns, 3) uint8 image tile
+
+    Returns:
+        list: The (rows, columns) boolean mask (or uint8 quantised probabilities) of each lookup table
+    """
+    codes = colour_codes(tile)
+
+    return [lut[codes] for lut in luts]
+
+
+def predict_tile(predicts: list, tile: np.ndarray) -> list:
+    """Apply several tile predictors to the same image tile
+
+    Args:
+        predicts (list): Functions mapping an image tile to its boolean mask or its probabilities
+        tile (np.ndarray): The (rows, columns, 3) image tile
+
+    Returns:
+        list: The prediction of each predictor
+    """
+    return [predict(tile) for predict in predicts]
+
+
+def timed(predict, tile: np.ndarray) -> tuple:
+    """Apply a tile predictor and measure its throughput
+
+    Args:
+        predict (callable): Function mapping an image tile to its boolean mask
+        tile (np.ndarray): The (rows, columns, 3) image tile
+
+    Returns:
+        tuple: The boolean mask and the throughput in pixels/s
+    """
+    start = time.perf_counter()
+    mask = predict(tile)
+
+    return mask, tile.shape[0] * tile.shape[1] / (time.perf_counter() - start)
+
+
+def predict_masks(predict, tiles, workers: int = 1):
+    """Predict the boolean masks of image tiles concurrently
+
+    At most workers tiles are predicted at the same time, so the tiles can be
+    read lazily (e.g. from image_tiles.iter_bands) within a bounded memory.
+
+    Args:
+        predict (callable): Function mapping an image tile to its boolean mask or its probabilities (e.g. predict_mask or lut_mask with their first arguments bound)
+        tiles (iterable): (key, tile) pairs, the key being passed through (e.g. the position of the tile)
+        workers (int, optional): Number of tiles predicted concurrently. Defaults to 1.
+
+    Yields:
+        tuple: The key, the boolean mask and the throughput in pixels/s of each tile, in the input order
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for key, tile in tiles:
+            pending.append((key, executor.submit(timed, predict, tile)))
+            del tile
+
+            # Wait for the oldest tile when all the workers are busy
+            if len(pending) >= workers:
+                key, future = pending.popleft()
+                yield key, *future.result()
+
+        # Collect the remaining tiles
+        while pending:
+            key, future = pending.popleft()
+            yield key, *future.result()
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+
+def peak_rss() -> float:
+    """Get the peak resident set size of the process since its last reset
+
+    Returns:
+        float: The peak RSS in MB (VmHWM on Linux, ru_maxrss otherwise)
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss() -> None:
+    """Reset the peak resident set size of the process to its current RSS (Linux only, ignored otherwise)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def io_bytes() -> tuple:
+    """Get the number of bytes read and written by the process through system calls
+
+    Returns:
+        tuple: The bytes read and written (None if /proc/self/io is not available)
+    """
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class Report:
+    """Record the wall time, CPU time, peak RSS and bytes read/written of named spans of a stage
+
+    Each span is labelled (e.g. with the marker) and the report is written as JSON.
+    When disabled, the spans only enter and leave an empty context.
+
+    The peak RSS of a span is the highest VmHWM read while it was open, the counter being
+    reset when a span starts, so that a span is not charged with the peaks of the previous ones.
+    """
+
+    def __init__(self, stage: str, slide: str, enabled: bool = True):
+        """
+        Args:
+            stage (str): Name of the stage (e.g. mask_generation)
+            slide (str): Name of the slide (lame)
+            enabled (bool, optional): Whether the spans are recorded. Defaults to True.
+        """
+        self.stage = stage
+        self.slide = slide
+        self.enabled = enabled
+        self.spans = []
+        self.open_spans = []
+        self.peak_rss_mb = 0.0
+        self.lock = threading.Lock()
+        self.start = time.perf_counter(), time.process_time()
+
+    def update_peaks(self) -> None:
+        """Charge the current peak RSS to the open spans and to the stage (the counter being reset by the spans)"""
+        rss = peak_rss()
+        self.peak_rss_mb = max(self.peak_rss_mb, rss)
+        for span in self.open_spans:
+            span["peak_rss_mb"] = max(span["peak_rss_mb"], rss)
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        """Record a span of the stage
+
+        Args:
+            name (str): Name of the span (e.g. predict)
+            **labels: Labels of the span (e.g. marker="PANCKm-CD8r_CD8")
+
+        Yields:
+            dict: The record of the span (None if disabled)
+        """
+        if not self.enabled:
+            yield None
+            return
+
+        record = {"name": name, **labels, "peak_rss_mb": 0.0}
+        with self.lock:
+            self.update_peaks()
+            reset_peak_rss()
+            self.open_spans.append(record)
+        read, written = io_bytes()
+        wall, cpu = time.perf_counter(), time.process_time()
+
+        try:
+            yield record
+        finally:
+            record["wall_s"] = time.perf_counter() - wall
+            record["cpu_s"] = time.process_time() - cpu
+            end_read, end_written = io_bytes()
+            if read is not None:
+                record["read_mb"] = (end_read - read) / 1024**2
+                record["written_mb"] = (end_written - written) / 1024**2
+            with self.lock:
+                self.update_peaks()
+                self.open_spans.remove(record)
+                self.spans.append(record)
+
+    def iterate(self, name: str, iterable, **labels):
+        """Record the time spent producing the items of an iterable (e.g. reading the image tiles) as a single span
+
+        Args:
+            name (str): Name of the span (e.g. read tiles)
+            iterable (iterable): The iterable
+            **labels: Labels of the span
+
+        Yields:
+            The items of the iterable
+        """
+        if not self.enabled:
+            yield from iterable
+            return
+
+        record = {"name": name, **labels, "items": 0, "wall_s": 0.0, "cpu_s": 0.0}
+        self.spans.append(record)
+        iterator = iter(iterable)
+        while True:
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                record["wall_s"] += time.perf_counter() - wall
+                record["cpu_s"] += time.thread_time() - cpu
+            record["items"] += 1
+            yield item
+
+    def write(self, report_f: str) -> None:
+        """Write the report as JSON (nothing if disabled)
+
+        Args:
+            report_f (str): Path to the report (e.g. results/reports/<stage>.json)
+        """
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.update_peaks()
+        report = {"stage": self.stage,
+                  "slide": self.slide,
+                  "wall_s": time.perf_counter() - self.start[0],
+                  "cpu_s": time.process_time() - self.start[1],
+                  "peak_rss_mb": self.peak_rss_mb,
+                  "spans": self.spans}
+
+        os.makedirs(os.path.dirname(report_f), exist_ok=True)
+        with open(report_f, "w") as f:
+            json.dump(report, f, indent=4)
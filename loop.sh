@@ -1,17 +1,5 @@
 #!/bin/bash
 
-# Array of values
-slides=("13AG06573-10" "13AG06573-18" "13AG06746-19" "13AG06746-22" "13AG06746-27" "14AG03250-32" "14AG03681-25" "14AG03681-31" "14AG06301-08" "14AG06301-09")
-
-# Loop through slides
-for slide in "${slides[@]}"; do
-    echo "Processing slide $slide"
-
-    # Replace the slide in the file
-    sed -i "3s/.*/lame: $slide/" config.yaml
-    sleep 2
-
-    # Run the snakemake pipeline
-    snakemake --use-singularity mask_generation
-    sleep 60
-done
\ No newline at end of file
+# Generate the masks of all the slides listed in config.yaml (lames) with a single Snakemake invocation,
+# the slides being scheduled concurrently within the available cores and memory (threads and mem_mb of each rule)
+snakemake --use-singularity --cores all --resources mem_mb=64000 masks
@@ -0,0 +1,110 @@
+import os
+import json
+import fcntl
+
+import hashing
+
+
+def read_manifest(manifest_f: str) -> dict:
+    """Read the manifest of a slide, recording the inputs of its artifacts
+
+    The manifest has two sections:
+    files: the hash of each input file with its size and modification time, so that a file is hashed again only if it changed
+    artifacts: the key of the inputs of each artifact (e.g. masks/<marker>_mask.tiff) with the inputs themselves
+
+    Args:
+        manifest_f (str): Path to the manifest (e.g. results/manifest.json)
+
+    Returns:
+        dict: The manifest (empty sections if it does not exist)
+    """
+    manifest = {"files": {}, "artifacts": {}}
+    if os.path.exists(manifest_f):
+        with open(manifest_f, "r") as f:
+            manifest.update(json.load(f))
+
+    return manifest
+
+
+def update_manifest(manifest_f: str, files: dict = None, artifacts: dict = None) -> None:
+    """Merge entries into the manifest of a slide
+
+    The manifest is locked while it is read, merged and replaced, so that the stages of a slide
+    running concurrently (e.g. the masks of the markers and of the microdissections) keep each other's entries.
+
+    Args:
+        manifest_f (str): Path to the manifest
+        files (dict, optional): Entries of the files section. Defaults to None.
+        artifacts (dict, optional): Entries of the artifacts section. Defaults to None.
+    """
+    os.makedirs(os.path.dirname(manifest_f), exist_ok=True)
+    with open(f"{manifest_f}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        manifest = read_manifest(manifest_f)
+        manifest["files"].update(files or {})
+        manifest["artifacts"].update(artifacts or {})
+
+        with open(f"{manifest_f}.tmp", "w") as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+        os.replace(f"{manifest_f}.tmp", manifest_f)
+
+
+def file_hash(manifest: dict, file_f: str) -> str:
+    """Get the hash of an input file, hashing its content only if its size or modification time changed
+
+    The new hashes are added to the manifest in memory, and saved with the next record.
+
+    Args:
+        manifest (dict): The manifest (see read_manifest)
+        file_f (str): Path to the file
+
+    Returns:
+        str: Hexadecimal hash of the file content (see hashing.file_hash)
+    """
+    stat = os.stat(file_f)
+    entry = manifest["files"].get(os.path.abspath(file_f))
+    if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+        entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": hashing.file_hash(file_f)}
+        manifest["files"][os.path.abspath(file_f)] = entry
+
+    return entry["hash"]
+
+
+def artifact_key(inputs: dict) -> str:
+    """Identify the inputs of an artifact
+
+    Args:
+        inputs (dict): The inputs (e.g. hashes of the image and the model, parameters and configuration keys)
+
+    Returns:
+        str: Hexadecimal hash of the inputs
+    """
+    return hashing.params_hash(inputs)
+
+
+def is_current(manifest: dict, name: str, inputs: dict) -> bool:
+    """Check whether an artifact was produced from the same inputs
+
+    Args:
+        manifest (dict): The manifest (see read_manifest)
+        name (str): Name of the artifact (e.g. masks/<marker>_mask.tiff, relative to the results folder)
+        inputs (dict): The current inputs of the artifact
+
+    Returns:
+        bool: Whether the recorded key of the artifact matches the inputs (the existence of the artifact is not checked)
+    """
+    return manifest["artifacts"].get(name, {}).get("key") == artifact_key(inputs)
+
+
+def record(manifest_f: str, manifest: dict, entries: dict) -> None:
+    """Record the inputs of produced artifacts in the manifest, in memory and on the disk
+
+    Args:
+        manifest_f (str): Path to the manifest
+        manifest (dict): The manifest (see read_manifest)
+        entries (dict): The inputs of each artifact by name
+    """
+    artifacts = {name: {"key": artifact_key(inputs), "inputs": inputs} for name, inputs in entries.items()}
+    manifest["artifacts"].update(artifacts)
+    update_manifest(manifest_f, files=manifest["files"], artifacts=artifacts)
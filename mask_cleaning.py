@@ -0,0 +1,85 @@
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# Approximate number of bytes held in memory per pixel while a band is labeled:
+# the boolean band, its int32 labels and the temporary arrays of the labeling
+BYTES_PER_PIXEL = 1 + 4 + 8
+
+# Connectivity of morphology.remove_small_objects (pixels sharing an edge)
+STRUCTURE = ndimage.generate_binary_structure(2, 1)
+
+
+def label_band(band: np.ndarray) -> tuple:
+    """Label the connected components of a band of the mask
+
+    Args:
+        band (np.ndarray): The (rows, columns) boolean band
+
+    Returns:
+        tuple: The int32 labels (0 for the background) and the number of components
+    """
+    labels = np.empty(band.shape, dtype=np.int32)
+    num_of_labels = ndimage.label(band, structure=STRUCTURE, output=labels)
+
+    return labels, num_of_labels
+
+
+def remove_small_objects(mask: np.ndarray, min_size: int, rows: int) -> np.ndarray:
+    """Remove the connected components smaller than min_size from a mask, band by band and in place
+
+    It gives the same result as morphology.remove_small_objects(mask, min_size=min_size)
+    without labeling the whole mask at once:
+    1. Each band of rows is labeled independently and the size of its components counted.
+    2. The components touching across the seam between two consecutive bands are merged
+       into a single object and their sizes summed.
+    3. Each band is labeled again and the pixels of the objects below min_size are removed.
+    Only a band of labels and the size of each component are held in memory, so the
+    mask can be a memory mapped file (e.g. np.lib.format.open_memmap).
+
+    Args:
+        mask (np.ndarray): The (height, width) boolean mask, modified in place
+        min_size (int): The smallest allowable object size
+        rows (int): Number of rows of each band
+
+    Returns:
+        np.ndarray: The cleaned mask
+    """
+    sizes = [np.zeros(1, dtype=np.int64)]  # Size of each component with a global id (0 for the background)
+    seams = []  # Pairs of global ids of the components touching across the seams
+    offset = 0  # Global id of the last component of the previous bands
+    last_row = None  # Global ids of the last row of the previous band
+
+    # Label each band and link its components to the ones of the previous band
+    for y in range(0, mask.shape[0], rows):
+        labels, num_of_labels = label_band(mask[y:y + rows])
+        sizes.append(np.bincount(labels.ravel(), minlength=num_of_labels + 1)[1:])
+
+        # Shift the labels to global ids
+        first_row = np.where(labels[0] > 0, labels[0] + offset, 0)
+        if last_row is not None:
+            touching = (last_row > 0) & (first_row > 0)
+            seams.append(np.unique(np.stack([last_row[touching], first_row[touching]], axis=1), axis=0))
+        last_row = np.where(labels[-1] > 0, labels[-1] + offset, 0)
+        offset += num_of_labels
+
+    # Merge the components linked across the seams into objects
+    sizes = np.concatenate(sizes)
+    seams = np.concatenate(seams) if seams else np.empty((0, 2), dtype=np.int64)
+    graph = coo_matrix((np.ones(len(seams), dtype=np.int8), (seams[:, 0], seams[:, 1])), shape=(offset + 1, offset + 1))
+    _, objects = connected_components(graph, directed=False)
+
+    # Keep the components of the objects that are large enough
+    keep = (np.bincount(objects, weights=sizes) >= min_size)[objects]
+    keep[0] = False
+
+    # Label each band again and remove the small objects
+    offset = 0
+    for y in range(0, mask.shape[0], rows):
+        labels, num_of_labels = label_band(mask[y:y + rows])
+        keep_band = np.concatenate([[False], keep[offset + 1:offset + num_of_labels + 1]])
+        mask[y:y + rows] = keep_band[labels]
+        offset += num_of_labels
+
+    return mask
@@ -1,49 +1,137 @@
-import numpy as np
 import pandas as pd
-import geopandas as gpd
-import matplotlib.pyplot as plt
 import yaml
+import sys
+import os
 
-# Load the configuration file
-with open("config.yaml", 'r') as stream:
-    config = yaml.safe_load(stream)
+from array_cache import ArrayCache
+import densities
+import image_tiles
+import instrumentation
+import manifest
+import pixel_store
 
-# Hyperparameters
-lame = config["lame"]  # Lame name
-markers = list(config["markers"].values()) + list(config["markers_microdissection"].values())  # List of markers including the microdissection markers
 
-MALDI_PIXEL_LENGTH = config["MALDI_PIXEL_LENGTH"]  # MALDI pixel length in micrometers
-IMAGE_PIXEL_LENGTH = config["IMAGE_PIXEL_LENGTH"]  # Image pixel length in micrometers
+def run(lame: str, config: dict, cache: ArrayCache = None) -> None:
+    """Compute the densities of the masks at the warped MALDI pixels of a slide
 
-path = f"{config['path_to_data']}/{lame}/results"  # Path to the results folder
+    The masks kept in memory by the mask generation run in the same process are used without decoding their files.
 
-# Read the MALDI aligned pixels geojson pickle file
-pixels_gdf = gpd.read_file(f"{path}/pixels_maldi_warped.geojson")
+    Args:
+        lame (str): Name of the slide
+        config (dict): The configuration (config.yaml)
+        cache (ArrayCache, optional): Cache of the decoded masks shared with the other stages run in the same process (see runner.py). Defaults to None.
+    """
+    # Without a shared cache, nothing is kept in memory between the stages
+    if cache is None:
+        cache = ArrayCache(memory_budget=0)
 
-# Compute the geometry centroid of each pixel
-pixels_gdf["centroid"] = pixels_gdf.geometry.centroid
+    # Hyperparameters
+    markers = list(config["markers"].values()) + list(config["markers_microdissection"].values())  # List of markers including the microdissection markers
 
-# Transform the centroid to tuple
-pixels_gdf["x_warped"] = pixels_gdf.centroid.x
-pixels_gdf["y_warped"] = pixels_gdf.centroid.y
+    MALDI_PIXEL_LENGTH = config["MALDI_PIXEL_LENGTH"]  # MALDI pixel length in micrometers
+    IMAGE_PIXEL_LENGTH = config["IMAGE_PIXEL_LENGTH"]  # Image pixel length in micrometers
 
-# Compute the half length of the square around the centroid in pixels
-l = int((MALDI_PIXEL_LENGTH / IMAGE_PIXEL_LENGTH) / 2)
+    path = f"{config['path_to_data']}/{lame}/results"  # Path to the results folder
 
-# Compute the density of each pixel
-for marker in markers:
-    mask = plt.imread(f"{path}/masks/{marker}_mask.png") > 0
-    pixels_gdf[f"Density_{'_'.join(marker.split('_')[1:])}"] = [np.mean(mask[int(y)-l:int(y)+l, int(x)-l:int(x)+l]) 
-                                                                for x, y in zip(pixels_gdf.x_warped, pixels_gdf.y_warped)]
+    # Record the time, memory and I/O of the densities of each marker if enabled
+    report = instrumentation.Report("mask_densities", lame, config["instrumentation"])
 
-# Adjust the data types of the density columns
-pixels_gdf = pixels_gdf.astype({f"Density_{'_'.join(marker.split('_')[1:])}":'float32'
-                                for marker in markers})
+    # Read the MALDI aligned pixels, their centroids being computed during the transfer
+    pixels_f = f"{path}/{config['warped_annotation_file']}"
+    pixels = cache.get(pixels_f, pixel_store.read_pixels)
+    pixels_df = pd.DataFrame({"id": pixels["id"], "x_warped": pixels["x"], "y_warped": pixels["y"]})
 
-# Save the geodataframe to a pickle file
-pixels_gdf.to_pickle(f"{path}/pixels_maldi_warped_density_gdf.pkl")
+    # Compute the half length of the square around the centroid in pixels
+    l = densities.window_half_length(MALDI_PIXEL_LENGTH, IMAGE_PIXEL_LENGTH)
+    density_key = densities.densities_key(pixels_f, l, config["density_mode"])
 
-# Save a dataframe without the geometries
-pixels_df = pd.DataFrame(pixels_gdf.drop(columns=["geometry", "centroid", "objectType"]))  # Remove the geometry columns
-pixels_df = pixels_df.astype({'id':'int32'})  # Adjust the id data type to int32
-pixels_df.to_csv(f"{path}/pixels_maldi_warped_density_df.csv", index=False)  # Save the dataframe to a csv file
\ No newline at end of file
+    # Rasterise the warped polygons of the pixels once into a label image for the densities in their polygons
+    if config["density_mode"] == "polygon":
+        import pixel_labels
+        with report.span("labels"):
+            labels_f = pixel_labels.get_labels(f"{path}/pixels_maldi_labels.tiff",
+                                               pixels_f,
+                                               pixels["corners"],
+                                               image_tiles.image_shape(f"{path}/images_aligned/HES.ome.tiff")[:2])
+    else:
+        labels_f = None
+
+    # Manifest of the slide recording the inputs of the masks and of the density columns
+    manifest_f = f"{path}/manifest.json"
+    slide_manifest = manifest.read_manifest(manifest_f)
+
+    # Densities of the previous run, whose columns are reused if their mask and densities parameters did not change
+    density_df_f = f"{path}/pixels_maldi_warped_density_df.csv"
+    previous_df = pd.read_csv(density_df_f) if os.path.exists(density_df_f) else pd.DataFrame()
+
+    # Compute the density of each pixel from the summed-area tables of the mask or from the labels of the pixels
+    entries = {}
+    for marker in markers:
+        column = f"Density_{'_'.join(marker.split('_')[1:])}"
+
+        # Inputs of the densities: the key of the mask recorded by the mask generation (or the hash of the mask if it was not recorded) and the densities parameters
+        mask_f = f"{path}/masks/{marker}_mask.tiff"
+        mask_key = slide_manifest["artifacts"].get(f"masks/{marker}_mask.tiff", {}).get("key") or manifest.file_hash(slide_manifest, mask_f)
+        entries[f"pixels_maldi_warped_density_df.csv/{column}"] = inputs = {"mask": mask_key, "densities": density_key}
+
+        with report.span("densities", marker=marker):
+            # Keep the column of the previous run
+            if column in previous_df and manifest.is_current(slide_manifest, f"pixels_maldi_warped_density_df.csv/{column}", inputs):
+                print(f"{marker} densities are up to date")
+                density = previous_df[column].values
+
+            else:
+                # Use the densities computed with the mask in the fused mode of the mask generation
+                density = None
+                if manifest.is_current(slide_manifest, f"masks/{marker}_density.npz", inputs):
+                    density = densities.read_densities(f"{path}/masks/{marker}_density.npz", density_key)
+                # Use the mask kept in memory by the mask generation, or read the saved mask band by band
+                mask = cache.get(mask_f) if density is None else None
+                if mask is not None:
+                    print(f"Computing the {marker} densities from the mask in memory")
+                    density = densities.array_densities(mask=mask,
+                                                        x=pixels_df.x_warped.values,
+                                                        y=pixels_df.y_warped.values,
+                                                        half_length=l,
+                                                        memory_budget=config["memory_budget"],
+                                                        labels_f=labels_f)
+                elif density is None:
+                    print(f"Computing the {marker} densities")
+                    density = densities.window_densities(mask_f=mask_f,
+                                                         x=pixels_df.x_warped.values,
+                                                         y=pixels_df.y_warped.values,
+                                                         half_length=l,
+                                                         memory_budget=config["memory_budget"],
+                                                         labels_f=labels_f)
+        pixels_df[column] = density
+
+    # Adjust the data types of the density columns
+    pixels_df = pixels_df.astype({f"Density_{'_'.join(marker.split('_')[1:])}":'float32'
+                                  for marker in markers})
+
+    # Save the geodataframe with the warped pixels and their centroids to a pickle file
+    import geopandas as gpd
+    import shapely
+    pixels_gdf = gpd.GeoDataFrame(pixels_df.assign(objectType="pixel",
+                                                   centroid=gpd.points_from_xy(pixels_df.x_warped, pixels_df.y_warped)),
+                                  geometry=shapely.polygons(pixels["corners"]))
+    with report.span("save"):
+        pixels_gdf.to_pickle(f"{path}/pixels_maldi_warped_density_gdf.pkl")
+
+        # Save the dataframe without the geometries to a csv file
+        pixels_df.to_csv(density_df_f, index=False)
+
+    # Record the inputs of the density columns
+    manifest.record(manifest_f, slide_manifest, entries)
+
+    # Write the report of the stage
+    report.write(f"{path}/reports/mask_densities.json")
+
+
+if __name__ == "__main__":
+    # Load the configuration file
+    with open("config.yaml", 'r') as stream:
+        config = yaml.safe_load(stream)
+
+    # Name of the lame (given by Snakemake or from the config)
+    run(sys.argv[1] if len(sys.argv) > 1 else config["lame"], config)
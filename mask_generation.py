@@ -1,168 +1,324 @@
 import numpy as np
-import xgboost as xgb
 import PIL
 from PIL import Image
-from skimage import io, morphology
-from skimage.filters import threshold_isodata
 from tqdm import tqdm
 import yaml
+import sys
 import os
 import gc
+from functools import partial
+
+from array_cache import ArrayCache
+import image_tiles
+import instrumentation
+import manifest
+from mask_outputs import MaskOutputs
+import probability_store
+import qupath
 
 # Increase the limit of allowed images size
 PIL.Image.MAX_IMAGE_PIXELS = 10e10
 
-# Load the configuration file
-with open("config.yaml", 'r') as stream:
-    config = yaml.safe_load(stream)
-
-# Hyperparameters
-lame = config["lame"]
-compression = config["compression"]
-markers = config["markers"]
-
-# Define the path to the masks and the QP projects
-path = f"{config['path_to_data']}/{lame}/results/masks"
-path_qp = f"{config['path_to_qp_projects']}/{lame}/export"
-
-# Extract the original width of the image
-with Image.open(f"{config['path_to_data']}/{lame}/results/images_aligned/HES.ome.tiff") as slide:
-    original_width = slide.size[0]
-
-# Create the directory if it does not exist
-os.makedirs(path, exist_ok=True)
-
-# Loop over all the markers
-for model, marker in markers.items():
-    
-    # Check if the mask already exists
-    if os.path.exists(f"{path}/{marker}_mask.png") and os.path.exists(f"{path}/{marker}_mask_compressed.png"):
-        print(f"{marker} mask already exists")
-    
-    # If model starts with "qupath", then we need to extract the masks from the QP project
-    elif model.startswith("qupath"):
-        print(f"Creating {marker} mask from QuPath project")
-        
-        # Determine the number of tiles
-        num_of_tiles = len([tile for tile in os.listdir(path_qp) if marker in tile])
-
-        # Read first channel of one of the tile images
-        tile = io.imread(f"{path_qp}/{marker}_mask_{num_of_tiles//2}_of_{num_of_tiles}.png")[:, :, 1]
-
-        # Compute isodata threshold 
-        thresh = threshold_isodata(tile)
-
-        # Repeat the process on all the tiles if the threshold does not isolate the signal
-        k = 0
-        while (tile < thresh).mean() == 0:
-            k += 1
-            # Raise an error if the threshold does not isolate the signal for all the tiles
-            if k > num_of_tiles:
-                raise ValueError(f"Marker {marker} threshold does not isolate the signal for all the tiles")
-            tile = io.imread(f"{path_qp}/{marker}_mask_{k}_of_{num_of_tiles}.png")[:, :, 1]
-            thresh = threshold_isodata(tile)
-
-        # Clear tile and mask to free memory
-        del tile
-        gc.collect()
 
-        # Create a generator of all tiles as binary masks
-        masks = ((io.imread(f"{path_qp}/{marker}_mask_{i}_of_{num_of_tiles}.png")[:, :, 1] < thresh) for i in range(1, num_of_tiles+1))
+def xgboost_masks(lame: str, config: dict, cache: ArrayCache, report: instrumentation.Report, mask_outputs: MaskOutputs,
+                  stain: str, stain_markers: list, inputs: dict) -> None:
+    """Generate the masks of the XGBoost markers of a stain, reading its aligned image once for all the markers
 
-        # Stack all the masks horizontally to create a single mask
-        mask = np.hstack([mask for mask in masks])
-        
-        # Delete the masks to free memory
-        del masks
-        gc.collect()
-        
-        # Complete the mask to meet the original image size
-        mask = np.pad(mask, ((0, 0), (0, original_width - mask.shape[1])), mode='edge')
+    The XGBoost backend (and SciPy for the cleaning) is imported only when this function is called.
 
-        # Save the mask
-        print(f"Saving the {marker}_mask")
-        PIL.Image.fromarray(mask).save(f"{path}/{marker}_mask.png")
+    Args:
+        lame (str): Name of the slide
+        config (dict): The configuration (config.yaml)
+        cache (ArrayCache): Cache of the decoded images shared with the other stages run in the same process
+        report (instrumentation.Report): Report of the stage
+        mask_outputs (MaskOutputs): Outputs of the masks of the slide
+        stain (str): Name of the stain (e.g. PANCKm-CD8r)
+        stain_markers (list): Names of the markers of the stain to generate
+        inputs (dict): The inputs of the mask of each marker (see MaskOutputs.xgboost_inputs)
+    """
+    import xgboost as xgb
+    import inference
+    import mask_cleaning
 
-        # Compres or cut the mask to a smaller size
-        mask_small = mask[::compression, ::compression]
+    path = mask_outputs.path
 
-        # Save the small mask
-        PIL.Image.fromarray(mask_small).save(f"{path}/{marker}_mask_compressed.png")
+    print(f"Creating {', '.join(stain_markers)} masks from their XGBoost models")
 
-        # Print the density of the mask
-        print(f"Density = {mask.mean()}")
+    # Path to the aligned image of the stain
+    image_f = f"{config['path_to_data']}/{lame}/results/images_aligned/{stain}.ome.tiff"
+    height, width, _ = image_tiles.image_shape(image_f)
 
-        # Delete the masks to free memory
-        del mask, mask_small
-        gc.collect()
-    
-    # If model starts with "xgboost", then we need to apply XGBoost model on the image
-    elif model.startswith("xgboost"):
-        print(f"Creating {marker} mask from its XGBoost model")
+    # Height of the bands in which the probabilities are thresholded
+    probs_rows = image_tiles.band_height(width=width,
+                                         memory_budget=config["memory_budget"],
+                                         bytes_per_pixel=probability_store.BYTES_PER_PIXEL)
+
+    # Prepare the mask of each marker and the predictor of the markers without cached probabilities
+    jobs, predicts, luts, outputs = [], [], [], []
+    for marker in stain_markers:
 
         # Load the model file
+        model_f = f"models/xgboost_{marker.split('_')[1]}.model"
         model = xgb.Booster()
-        model.load_model(f"models/xgboost_{marker.split('_')[1]}.model")
+        model.load_model(model_f)
 
-        # Set the model to use GPU
-        model.set_param({'device':'gpu'})
+        # Set the device of the model and the number of tiles predicted concurrently
+        workers = inference.configure_model(model,
+                                            device=config["device"],
+                                            workers=config["workers"],
+                                            nthread=config["nthread"])
 
         # Load the model parameters
         with open(f"models/xgboost_{marker.split('_')[1]}.yaml", "r") as f:
             model_params = yaml.safe_load(f)
 
         # Extract the model parameters
-        threshold = model_params["threshold"]
-        min_size = model_params["min_size"]
-
-        # Cut the image into vertical tiles
-        img_tiles = np.array_split(ary=io.imread(f"{config['path_to_data']}/{lame}/results/images_aligned/{marker.split('_')[0]}.ome.tiff"), 
-                                   indices_or_sections=100,
+        job = {"marker": marker, "threshold": model_params["threshold"], "min_size": model_params["min_size"]}
+        jobs.append(job)
+
+        # Create the mask as a memory mapped file or in memory
+        if config["streaming"]:
+            job["mask"] = np.lib.format.open_memmap(f"{path}/{marker}_mask.npy", mode="w+", dtype=bool, shape=(height, width))
+        else:
+            job["mask"] = np.empty((height, width), dtype=bool)
+
+        # Cached quantised probabilities of the marker, valid for the same image and model
+        job["probs_f"] = f"{config['path_to_data']}/{lame}/results/probabilities/{marker}_probabilities.tiff"
+        if config["probability_cache"]:
+            job["probs_key"] = manifest.artifact_key({"image": inputs[marker]["image"], "model": inputs[marker]["model"]})
+            cached = probability_store.probabilities_key(job["probs_f"]) == job["probs_key"]
+        else:
+            cached = False
+
+        # Threshold the cached probabilities band by band without running the model
+        if cached:
+            print(f"Thresholding the cached probabilities {job['probs_f']}")
+            with report.span("threshold cache", marker=marker):
+                for y, probs_band in probability_store.iter_probability_bands(job["probs_f"], probs_rows):
+                    job["mask"][y:y + probs_band.shape[0]] = inference.threshold_probabilities(probs_band, job["threshold"])
+
+        # Predict the quantised probabilities to cache them, with the colour lookup table of the model or with the model itself
+        elif config["probability_cache"]:
+            if config["streaming"]:
+                job["output"] = np.lib.format.open_memmap(f"{path}/{marker}_probabilities.npy", mode="w+", dtype=np.uint8, shape=(height, width))
+            else:
+                job["output"] = np.empty((height, width), dtype=np.uint8)
+            if config["lut"]:
+                luts.append(inference.probability_lut(model, model_f))
+            else:
+                predicts.append(partial(inference.predict_probabilities, model))
+            outputs.append(job["output"])
+
+        # Predict the masks directly, with the colour lookup table of the model or with the model itself
+        else:
+            if config["lut"]:
+                luts.append(inference.colour_lut(model, model_f, job["threshold"]))
+            else:
+                predicts.append(partial(inference.predict_mask, model, job["threshold"]))
+            outputs.append(job["mask"])
+
+        del model
+
+    # Apply the models of all the markers to each image tile, the tile being read once
+    if outputs:
+        # Read the image band by band from the disk and write the predictions as they go
+        if config["streaming"]:
+            # Define the height of the bands to fit the bands of all the workers and the predictions of all the markers in the memory budget
+            rows = image_tiles.band_height(width=width,
+                                           memory_budget=config["memory_budget"] / workers,
+                                           bytes_per_pixel=image_tiles.BYTES_PER_PIXEL + len(outputs) - 1,
+                                           multiple=image_tiles.segment_height(image_f))
+            num_of_tiles = -(-height // rows)
+
+            # Generator of the image bands with their position in the mask
+            img_tiles = (((slice(y, y + img_band.shape[0]), slice(None)), img_band)
+                         for y, img_band in image_tiles.iter_bands(image_f, rows))
+            print(f"Processing the bands of {rows} rows")
+
+        # Read the whole image and cut it into vertical tiles
+        else:
+            from skimage import io
+            image = cache.get(image_f, io.imread)
+            num_of_tiles = 100
+
+            # Generator of the vertical image tiles with their position in the mask
+            tiles = np.array_split(ary=image,
+                                   indices_or_sections=num_of_tiles,
                                    axis=1)
-        
-        # Apply the model to each image tile
-        mask_tiles = []
-        print("Processing the tiles")
-        for i, img_tile in tqdm(enumerate(img_tiles)):
-            # Transform the image into a 2D matrix
-            dtest = xgb.DMatrix(img_tile.reshape(-1, 3))
-
-            # Predict the mask
-            preds = model.predict(dtest)
-
-            # Append the mask to the mask_tiles list
-            mask_tiles.append(preds.reshape(img_tile.shape[:2]) > threshold)
-
-        # Delete the model and image tiles to free memory
-        del model, img_tiles
+            offsets = np.cumsum([0] + [tile.shape[1] for tile in tiles])
+            img_tiles = (((slice(None), slice(x, x + tile.shape[1])), tile) for x, tile in zip(offsets, tiles))
+            print("Processing the tiles")
+
+        # Predict the markers with their colour lookup tables (computing the colour codes once) or with their models
+        if config["lut"]:
+            predict = partial(inference.lut_masks, luts)
+        else:
+            predict = partial(inference.predict_tile, predicts)
+
+        # Apply the models to the image tiles concurrently and write each predicted tile at its position,
+        # recording the time spent reading the tiles apart from the prediction
+        rates = []
+        img_tiles = report.iterate("read tiles", img_tiles, stain=stain)
+        with report.span("predict", stain=stain, markers=stain_markers):
+            progress = tqdm(inference.predict_masks(predict, img_tiles, workers), total=num_of_tiles)
+            for position, output_tiles, rate in progress:
+                for output, output_tile in zip(outputs, output_tiles):
+                    output[position] = output_tile
+                rates.append(rate)
+                progress.set_postfix(pixels_per_s=f"{rate:.3g}")
+        print(f"Throughput per tile = {np.mean(rates):.3g} pixels/s (min {np.min(rates):.3g}, max {np.max(rates):.3g})")
+
+        # Delete the models and image tiles to free memory
+        del predict, predicts, luts, outputs, img_tiles
+        if not config["streaming"]:
+            del image, tiles
         gc.collect()
 
-        # Concatenate the mask tiles into a single mask
-        mask = np.concatenate(mask_tiles, axis=1)
+    # Clean and save the mask of each marker
+    for job in jobs:
+        marker, mask = job["marker"], job.pop("mask")
+
+        # Cache the probabilities and threshold them band by band
+        if "output" in job:
+            output = job.pop("output")
+            print(f"Caching the probabilities in {job['probs_f']}")
+            with report.span("cache probabilities", marker=marker):
+                probability_store.write_probabilities(job["probs_f"], output, job["probs_key"])
+                for y in range(0, height, probs_rows):
+                    mask[y:y + probs_rows] = inference.threshold_probabilities(output[y:y + probs_rows], job["threshold"])
+
+            # Delete the probabilities and their memory mapped file
+            del output
+            gc.collect()
+            if os.path.exists(f"{path}/{marker}_probabilities.npy"):
+                os.remove(f"{path}/{marker}_probabilities.npy")
+
+        # Write the memory mapped mask to the disk
+        if isinstance(mask, np.memmap):
+            mask.flush()
 
         # Print the density of the mask
-        print(f"Density before cleaning = {mask.mean()}")
+        print(f"Density of {marker} before cleaning = {mask.mean()}")
 
-        # Delete the mask tiles to free memory
-        del mask_tiles
-        gc.collect()
-
-        # Clean the mask
+        # Clean the mask band by band without labeling the whole mask at once
         print(f"Cleaning the {marker}_mask")
-        mask = morphology.remove_small_objects(mask, min_size=min_size)
+        with report.span("clean", marker=marker):
+            mask = mask_cleaning.remove_small_objects(mask,
+                                                      min_size=job["min_size"],
+                                                      rows=image_tiles.band_height(width=mask.shape[1],
+                                                                                   memory_budget=config["memory_budget"],
+                                                                                   bytes_per_pixel=mask_cleaning.BYTES_PER_PIXEL))
 
         # Print the density of the mask
-        print(f"Density after cleaning = {mask.mean()}")
+        print(f"Density of {marker} after cleaning = {mask.mean()}")
 
-        # Save the cleaned mask and compressed version of it
-        print(f"Saving the {marker}_mask")
-        PIL.Image.fromarray(mask).save(f"{config['path_to_data']}/{lame}/results/masks/{marker}_mask.png")
-        PIL.Image.fromarray(mask[::compression, ::compression]).save(f"{config['path_to_data']}/{lame}/results/masks/{marker}_mask_compressed.png")
+        # Save the cleaned mask with its downsampled levels and/or its densities
+        mask_outputs.save(marker, mask, inputs[marker])
 
-        # Delete the mask to free memory
+        # Delete the mask and its memory mapped file to free memory
         del mask
         gc.collect()
+        if os.path.exists(f"{path}/{marker}_mask.npy"):
+            os.remove(f"{path}/{marker}_mask.npy")
+
+
+def run(lame: str, config: dict, cache: ArrayCache = None) -> None:
+    """Generate the masks of the markers of a slide, from the QuPath exports or the XGBoost models
+
+    The heavy libraries (XGBoost, scikit-image, SciPy) are imported only when a mask has to be generated with them.
+
+    Args:
+        lame (str): Name of the slide
+        config (dict): The configuration (config.yaml)
+        cache (ArrayCache, optional): Cache of the decoded images and masks shared with the other stages run in the same process (see runner.py). Defaults to None.
+    """
+    # Without a shared cache, nothing is kept in memory between the stages
+    if cache is None:
+        cache = ArrayCache(memory_budget=0)
+
+    # Hyperparameters
+    markers = config["markers"]
+
+    # Define the path to the QP projects
+    path_qp = f"{config['path_to_qp_projects']}/{lame}/export"
+
+    # Record the time, memory and I/O of the steps of each marker if enabled
+    report = instrumentation.Report("mask_generation", lame, config["instrumentation"])
+
+    # Extract the original width of the image
+    with Image.open(f"{config['path_to_data']}/{lame}/results/images_aligned/HES.ome.tiff") as slide:
+        original_width = slide.size[0]
+
+    # Masks, densities and manifest entries of the slide
+    mask_outputs = MaskOutputs(lame, config, cache, report)
+    path = mask_outputs.path
+
+    # Loop over all the markers, grouping the XGBoost markers by the image of their stain
+    stains, inputs = {}, {}
+    for model, marker in markers.items():
+        # Inputs of the mask: the exported tiles and the width of the mask
+        if model.startswith("qupath"):
+            inputs[marker] = mask_outputs.qupath_inputs(path_qp, marker, original_width)
+
+        # Inputs of the mask: the aligned image of the stain, the model and its parameters
+        elif model.startswith("xgboost"):
+            with open(f"models/xgboost_{marker.split('_')[1]}.yaml", "r") as f:
+                model_params = yaml.safe_load(f)
+            inputs[marker] = mask_outputs.xgboost_inputs(f"{config['path_to_data']}/{lame}/results/images_aligned/{marker.split('_')[0]}.ome.tiff",
+                                                         f"models/xgboost_{marker.split('_')[1]}.model",
+                                                         model_params)
+
+        # Raise an error if the model is not recognized
+        else:
+            raise ValueError(f"Model {model} not recognized")
+
+        # Check if the mask already exists and its inputs did not change
+        if mask_outputs.exists(marker, inputs[marker]):
+            print(f"{marker} mask already exists")
+
+        # If model starts with "qupath", then we need to extract the masks from the QP project
+        elif model.startswith("qupath"):
+            print(f"Creating {marker} mask from QuPath project")
+
+            # List the exported tiles
+            tiles = qupath.export_tiles(path_qp, marker)
+
+            # Decode the tiles concurrently into the mask of the original image size,
+            # thresholded with the isodata threshold of the histogram of all the tiles
+            with report.span("assemble", marker=marker):
+                mask, thresh = qupath.assemble_mask(tiles,
+                                                    width=original_width,
+                                                    out_f=f"{path}/{marker}_mask.npy" if config["streaming"] else None)
+            print(f"Threshold = {thresh}")
+
+            # Save the mask with its downsampled levels and/or its densities
+            mask_outputs.save(marker, mask, inputs[marker])
+
+            # Print the density of the mask
+            print(f"Density = {mask.mean()}")
+
+            # Delete the mask and its memory mapped file to free memory
+            del mask
+            gc.collect()
+            if os.path.exists(f"{path}/{marker}_mask.npy"):
+                os.remove(f"{path}/{marker}_mask.npy")
+
+        # If model starts with "xgboost", then we need to apply XGBoost model on the image of the stain
+        else:
+            stains.setdefault(marker.split('_')[0], []).append(marker)
+
+    # Loop over the stains, reading each image once for all its XGBoost markers
+    for stain, stain_markers in stains.items():
+        xgboost_masks(lame, config, cache, report, mask_outputs, stain, stain_markers, inputs)
+
+    # Write the report of the stage
+    report.write(f"{config['path_to_data']}/{lame}/results/reports/mask_generation.json")
+
+
+if __name__ == "__main__":
+    # Load the configuration file
+    with open("config.yaml", 'r') as stream:
+        config = yaml.safe_load(stream)
 
-    # Raise an error if the model is not recognized
-    else:
-        raise ValueError(f"Model {model} not recognized")
\ No newline at end of file
+    # Name of the lame (given by Snakemake or from the config)
+    run(sys.argv[1] if len(sys.argv) > 1 else config["lame"], config)
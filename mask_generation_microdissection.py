@@ -1,87 +1,81 @@
-import numpy as np
-import xgboost as xgb
 import PIL
 from PIL import Image
-from skimage import io, morphology
-from skimage.filters import threshold_isodata
-from tqdm import tqdm
 import yaml
-import os
+import sys
+
+from array_cache import ArrayCache
+import instrumentation
+from mask_outputs import MaskOutputs
+import qupath
 
 # Increase the limit of allowed images size
 PIL.Image.MAX_IMAGE_PIXELS = 10e10
 
-# Load the configuration file
-with open("config.yaml", 'r') as stream:
-    config = yaml.safe_load(stream)
-
-# Hyperparameters
-lame = config["lame"]
-compression = config["compression"]
-markers = config["markers_microdissection"].values()
-
-# Define the path to the masks and the QP projects
-path = f"{config['path_to_data']}/{lame}/results/masks"
-path_qp = f"{config['path_to_qp_projects']}/{lame}/export"
-
-# Extract the original width of the image
-with Image.open(f"{config['path_to_data']}/{lame}/results/images_aligned/HES.ome.tiff") as slide:
-    original_width = slide.size[0]
-
-# Create the directory if it does not exist
-os.makedirs(path, exist_ok=True)
-
-# Loop over all the markers
-for marker in markers:
-    
-    # Check if the mask already exists
-    if os.path.exists(f"{path}/{marker}_mask.png") and os.path.exists(f"{path}/{marker}_mask_compressed.png"):
-        print(f"{marker} mask already exists")
-    
-    # Extract the masks from the QP project
-    else:
-        print(f"Creating {marker} mask from QuPath project")
-        
-        # Determine the number of tiles
-        num_of_tiles = len([tile for tile in os.listdir(path_qp) if marker in tile])
-
-        # Read first channel of one of the tile images
-        tile = io.imread(f"{path_qp}/{marker}_mask_{num_of_tiles//2}_of_{num_of_tiles}.png")[:, :, 1]
-
-        # Compute isodata threshold 
-        thresh = threshold_isodata(tile)
-
-        # Repeat the process on all the tiles if the threshold does not isolate the signal
-        k = 0
-        while (tile < thresh).mean() == 0:
-            k += 1
-            # Raise an error if the threshold does not isolate the signal for all the tiles
-            if k > num_of_tiles:
-                raise ValueError(f"Marker {marker} threshold does not isolate the signal for all the tiles")
-            tile = io.imread(f"{path_qp}/{marker}_mask_{k}_of_{num_of_tiles}.png")[:, :, 1]
-            thresh = threshold_isodata(tile)
-
-        # Clear tile and mask to free memory
-        del tile
-
-        # Create a generator of all tiles as binary masks
-        masks = ((io.imread(f"{path_qp}/{marker}_mask_{i}_of_{num_of_tiles}.png")[:, :, 1] < thresh) for i in range(1, num_of_tiles+1))
-
-        # Stack all the masks horizontally to create a single mask
-        mask = np.hstack([mask for mask in masks])
-
-        # Complete the mask to meet the original image size
-        mask = np.pad(mask, ((0, 0), (0, original_width - mask.shape[1])), mode='edge')
-
-        # Save the mask
-        print(f"Saving the {marker}_mask")
-        PIL.Image.fromarray(mask).save(f"{path}/{marker}_mask.png")
-
-        # Compres or cut the mask to a smaller size
-        mask_small = mask[::compression, ::compression]
-
-        # Save the small mask
-        PIL.Image.fromarray(mask_small).save(f"{path}/{marker}_mask_compressed.png")
-
-        # Print the density of the mask
-        print(f"Density = {mask.mean()}")
\ No newline at end of file
+
+def run(lame: str, config: dict, cache: ArrayCache = None) -> None:
+    """Generate the masks of the microdissections of a slide from the QuPath exports
+
+    Args:
+        lame (str): Name of the slide
+        config (dict): The configuration (config.yaml)
+        cache (ArrayCache, optional): Cache of the decoded masks shared with the other stages run in the same process (see runner.py). Defaults to None.
+    """
+    # Without a shared cache, nothing is kept in memory between the stages
+    if cache is None:
+        cache = ArrayCache(memory_budget=0)
+
+    # Hyperparameters
+    markers = config["markers_microdissection"].values()
+
+    # Define the path to the QP projects
+    path_qp = f"{config['path_to_qp_projects']}/{lame}/export"
+
+    # Record the time, memory and I/O of the steps of each marker if enabled
+    report = instrumentation.Report("mask_generation_microdissection", lame, config["instrumentation"])
+
+    # Extract the original width of the image
+    with Image.open(f"{config['path_to_data']}/{lame}/results/images_aligned/HES.ome.tiff") as slide:
+        original_width = slide.size[0]
+
+    # Masks, densities and manifest entries of the slide
+    mask_outputs = MaskOutputs(lame, config, cache, report)
+
+    # Loop over all the markers
+    for marker in markers:
+        inputs = mask_outputs.qupath_inputs(path_qp, marker, original_width)
+
+        # Check if the mask already exists and its inputs did not change
+        if mask_outputs.exists(marker, inputs):
+            print(f"{marker} mask already exists")
+
+        # Extract the masks from the QP project
+        else:
+            print(f"Creating {marker} mask from QuPath project")
+
+            # List the exported tiles
+            tiles = qupath.export_tiles(path_qp, marker)
+
+            # Decode the tiles concurrently into the mask of the original image size,
+            # thresholded with the isodata threshold of the histogram of all the tiles
+            with report.span("assemble", marker=marker):
+                mask, thresh = qupath.assemble_mask(tiles,
+                                                    width=original_width)
+            print(f"Threshold = {thresh}")
+
+            # Save the mask with its downsampled levels and/or its densities
+            mask_outputs.save(marker, mask, inputs)
+
+            # Print the density of the mask
+            print(f"Density = {mask.mean()}")
+
+    # Write the report of the stage
+    report.write(f"{config['path_to_data']}/{lame}/results/reports/mask_generation_microdissection.json")
+
+
+if __name__ == "__main__":
+    # Load the configuration file
+    with open("config.yaml", 'r') as stream:
+        config = yaml.safe_load(stream)
+
+    # Name of the lame (given by Snakemake or from the config)
+    run(sys.argv[1] if len(sys.argv) > 1 else config["lame"], config)
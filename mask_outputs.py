@@ -0,0 +1,165 @@
+import os
+import numpy as np
+
+from array_cache import ArrayCache
+import densities
+import image_tiles
+import instrumentation
+import manifest
+import mask_store
+import pixel_store
+import qupath
+
+
+class MaskOutputs:
+    """Outputs of the mask generation of a slide: the masks, their densities at the warped MALDI pixels and their manifest entries
+
+    The masks and the microdissection masks share the same outputs. A mask is recorded in the manifest
+    of the slide with its inputs, so that only the masks whose inputs changed are recomputed. In the fused
+    mode, the densities at the warped MALDI pixels are computed from the masks still in memory and recorded
+    with the key of the mask they were computed from.
+    """
+
+    def __init__(self, lame: str, config: dict, cache: ArrayCache, report: instrumentation.Report):
+        """
+        Args:
+            lame (str): Name of the slide
+            config (dict): The configuration (config.yaml)
+            cache (ArrayCache): Cache of the decoded arrays shared with the other stages run in the same process (see runner.py)
+            report (instrumentation.Report): Report of the stage recording the save and density spans
+        """
+        self.config = config
+        self.cache = cache
+        self.report = report
+        self.levels = config["mask_levels"]
+
+        # Create the directory of the masks if it does not exist
+        self.path = f"{config['path_to_data']}/{lame}/results/masks"
+        os.makedirs(self.path, exist_ok=True)
+
+        # Manifest of the slide recording the inputs of the masks
+        self.manifest_f = f"{config['path_to_data']}/{lame}/results/manifest.json"
+        self.manifest = manifest.read_manifest(self.manifest_f)
+
+        # In the fused mode, the densities at the warped MALDI pixels are computed from the masks still in memory
+        self.fused = config["fused_densities"]
+        self.write_masks = config["write_masks"] or not self.fused
+        if self.fused:
+            pixels_f = f"{config['path_to_data']}/{lame}/results/{config['warped_annotation_file']}"
+            self.pixels = cache.get(pixels_f, pixel_store.read_pixels)
+            self.half_length = densities.window_half_length(config["MALDI_PIXEL_LENGTH"], config["IMAGE_PIXEL_LENGTH"])
+            self.density_key = densities.densities_key(pixels_f, self.half_length, config["density_mode"])
+
+            # Label image of the warped MALDI pixels for the densities in their polygons
+            if config["density_mode"] == "polygon":
+                import pixel_labels
+                self.labels_f = pixel_labels.get_labels(f"{config['path_to_data']}/{lame}/results/pixels_maldi_labels.tiff",
+                                                        pixels_f,
+                                                        self.pixels["corners"],
+                                                        image_tiles.image_shape(f"{config['path_to_data']}/{lame}/results/images_aligned/HES.ome.tiff")[:2])
+            else:
+                self.labels_f = None
+
+    def file_hash(self, file_f: str) -> str:
+        """Get the hash of an input file of a mask, memoised in the manifest (see manifest.file_hash)
+
+        Args:
+            file_f (str): Path to the file
+
+        Returns:
+            str: Hexadecimal hash of the file content
+        """
+        return manifest.file_hash(self.manifest, file_f)
+
+    def qupath_inputs(self, path_qp: str, marker: str, width: int) -> dict:
+        """Get the inputs of the mask of a marker exported from QuPath
+
+        Args:
+            path_qp (str): Path to the export directory of the QuPath project
+            marker (str): Name of the marker
+            width (int): Width of the mask
+
+        Returns:
+            dict: The hashes of the exported tiles, the width of the mask and the mask levels
+        """
+        return {"tiles": {os.path.basename(tile_f): self.file_hash(tile_f) for tile_f in qupath.export_tiles(path_qp, marker)},
+                "width": width,
+                "mask_levels": self.levels}
+
+    def xgboost_inputs(self, image_f: str, model_f: str, model_params: dict) -> dict:
+        """Get the inputs of the mask of a marker predicted by an XGBoost model
+
+        Args:
+            image_f (str): Path to the aligned image of the stain
+            model_f (str): Path to the model
+            model_params (dict): The model parameters (threshold and min_size)
+
+        Returns:
+            dict: The hashes of the image and the model, the model parameters, the mask levels and whether the
+                  mask is thresholded from the quantised probabilities (not bit-identical to the direct prediction)
+        """
+        return {"image": self.file_hash(image_f),
+                "model": self.file_hash(model_f),
+                "threshold": model_params["threshold"],
+                "min_size": model_params["min_size"],
+                "probability_cache": self.config["probability_cache"],
+                "mask_levels": self.levels}
+
+    def exists(self, marker: str, inputs: dict) -> bool:
+        """Check whether the mask of a marker (and its densities in the fused mode) is up to date with its inputs
+
+        The mask is recorded in the manifest even if it is not saved (write_masks False),
+        its densities being recorded with the key of the mask they were computed from.
+        In the fused mode, the missing densities of an up to date saved mask are computed from the saved mask.
+
+        Args:
+            marker (str): Name of the marker
+            inputs (dict): The inputs of the mask (e.g. see qupath_inputs)
+
+        Returns:
+            bool: Whether the marker can be skipped
+        """
+        mask_f = f"{self.path}/{marker}_mask.tiff"
+        if not manifest.is_current(self.manifest, f"masks/{marker}_mask.tiff", inputs) or (self.write_masks and not os.path.exists(mask_f)):
+            return False
+
+        density_inputs = {"mask": manifest.artifact_key(inputs), "densities": self.density_key} if self.fused else None
+        if self.fused and not (manifest.is_current(self.manifest, f"masks/{marker}_density.npz", density_inputs) and os.path.exists(f"{self.path}/{marker}_density.npz")):
+            if not os.path.exists(mask_f):
+                return False
+            print(f"Computing the {marker} densities from the saved mask")
+            with self.report.span("densities", marker=marker):
+                densities.write_densities(f"{self.path}/{marker}_density.npz",
+                                          densities.window_densities(mask_f, self.pixels["x"], self.pixels["y"], self.half_length, self.config["memory_budget"], self.labels_f),
+                                          self.density_key)
+            manifest.record(self.manifest_f, self.manifest, {f"masks/{marker}_density.npz": density_inputs})
+
+        return True
+
+    def save(self, marker: str, mask: np.ndarray, inputs: dict) -> None:
+        """Save the mask of a marker with its downsampled levels, and its densities in the fused mode, and record their inputs
+
+        Args:
+            marker (str): Name of the marker
+            mask (np.ndarray): The (height, width) boolean mask, in memory or memory mapped
+            inputs (dict): The inputs of the mask (e.g. see qupath_inputs)
+        """
+        entries = {f"masks/{marker}_mask.tiff": inputs}
+
+        if self.write_masks:
+            print(f"Saving the {marker}_mask")
+            with self.report.span("save", marker=marker):
+                mask_store.write_mask(f"{self.path}/{marker}_mask.tiff", mask, levels=self.levels, memory_budget=self.config["memory_budget"])
+
+            # Keep the mask in memory for the densities if it is not memory mapped
+            self.cache.put(f"{self.path}/{marker}_mask.tiff", mask)
+
+        if self.fused:
+            print(f"Computing the {marker} densities at the MALDI pixels")
+            with self.report.span("densities", marker=marker):
+                densities.write_densities(f"{self.path}/{marker}_density.npz",
+                                          densities.array_densities(mask, self.pixels["x"], self.pixels["y"], self.half_length, self.config["memory_budget"], self.labels_f),
+                                          self.density_key)
+            entries[f"masks/{marker}_density.npz"] = {"mask": manifest.artifact_key(inputs), "densities": self.density_key}
+
+        manifest.record(self.manifest_f, self.manifest, entries)
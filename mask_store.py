@@ -0,0 +1,167 @@
+import numpy as np
+import tifffile
+
+import image_tiles
+
+# Size of the square tiles in which the masks are stored
+TILE = 512
+
+# Approximate number of bytes held in memory per mask pixel while a level is downsampled:
+# the boolean rows read from the mask and their padded copy
+BYTES_PER_PIXEL = 2
+
+
+def iter_tiles(bands, width: int, tile: int = TILE):
+    """Split horizontal bands into the padded square tiles of a tiled TIFF
+
+    Args:
+        bands (iterable): Bands of tile rows (the last one may be shorter) covering the whole image
+        width (int): Width of the image
+        tile (int, optional): Size of the tiles. Defaults to TILE.
+
+    Yields:
+        np.ndarray: The (tile, tile) tiles in row-major order, padded with zeros at the image border
+    """
+    for band in bands:
+        for x in range(0, width, tile):
+            chunk = np.asarray(band[:, x:x + tile])
+            if chunk.shape != (tile, tile):
+                chunk = np.pad(chunk, ((0, tile - chunk.shape[0]), (0, tile - chunk.shape[1])))
+            yield chunk
+
+
+def level_bands(mask: np.ndarray, factor: int, height: int, rows: int):
+    """Downsample a boolean mask by area averaging, band by band
+
+    Args:
+        mask (np.ndarray): The (height, width) boolean mask (e.g. a memory mapped file)
+        factor (int): Downsampling factor, each level pixel averages a factor x factor block of the mask
+        height (int): Number of rows of the level bands
+        rows (int): Maximum number of mask rows read at once (rounded to a multiple of factor)
+
+    Yields:
+        np.ndarray: The uint8 bands of the level, the fraction of the block in the mask scaled to 0-255
+    """
+    mask_height, mask_width = mask.shape
+    level_height, level_width = -(-mask_height // factor), -(-mask_width // factor)
+    step = max(1, rows // factor) * factor
+
+    # Number of mask columns in each block (smaller for the last block)
+    col_counts = np.diff(np.minimum(np.arange(level_width + 1) * factor, mask_width))
+
+    for ly in range(0, level_height, height):
+        y0, y1 = ly * factor, min(mask_height, (ly + height) * factor)
+
+        # Sum the mask over the blocks, step rows at a time
+        sums = []
+        for y in range(y0, y1, step):
+            chunk = np.asarray(mask[y:min(y + step, y1)])
+            num_of_rows = -(-chunk.shape[0] // factor)
+            chunk = np.pad(chunk, ((0, num_of_rows * factor - chunk.shape[0]), (0, level_width * factor - mask_width)))
+            sums.append(chunk.reshape(num_of_rows, factor, level_width, factor).sum(axis=(1, 3), dtype=np.uint32))
+        sums = np.concatenate(sums)
+
+        # Divide by the number of mask pixels in each block
+        row_counts = np.diff(np.minimum(np.arange(ly, ly + sums.shape[0] + 1) * factor, mask_height))
+        yield np.round(sums * 255 / np.outer(row_counts, col_counts)).astype(np.uint8)
+
+
+def write_mask(mask_f: str, mask: np.ndarray, levels: list = (4, 16, 100), memory_budget: float = 1024, workers: int = None) -> None:
+    """Save a boolean mask as a tiled, bit-packed and compressed TIFF with downsampled levels
+
+    The full resolution mask is stored with 1 bit per pixel in zlib compressed tiles,
+    the tiles being compressed in parallel. The area-averaged levels are stored as uint8
+    SubIFDs (0 to 255 for the fraction of the block in the mask) for viewing.
+    The mask is read band by band, so it can be a memory mapped file.
+
+    Args:
+        mask_f (str): Path to the mask file (e.g. results/masks/<marker>_mask.tiff)
+        mask (np.ndarray): The (height, width) boolean mask
+        levels (list, optional): Downsampling factors of the levels. Defaults to (4, 16, 100).
+        memory_budget (float, optional): Memory budget in MB for the mask rows read at once to compute the levels. Defaults to 1024.
+        workers (int, optional): Number of threads compressing the tiles (None: chosen by tifffile). Defaults to None.
+    """
+    height, width = mask.shape
+    rows = image_tiles.band_height(width=width, memory_budget=memory_budget, bytes_per_pixel=BYTES_PER_PIXEL)
+
+    with tifffile.TiffWriter(mask_f, bigtiff=True) as tif:
+        # Write the full resolution mask
+        tif.write(iter_tiles((mask[y:y + TILE] for y in range(0, height, TILE)), width),
+                  shape=(height, width),
+                  dtype=bool,
+                  tile=(TILE, TILE),
+                  photometric="minisblack",
+                  compression="zlib",
+                  subifds=len(levels),
+                  maxworkers=workers,
+                  metadata={"levels": list(levels)})
+
+        # Write the downsampled levels
+        for factor in levels:
+            tif.write(iter_tiles(level_bands(mask, factor, TILE, rows), -(-width // factor)),
+                      shape=(-(-height // factor), -(-width // factor)),
+                      dtype=np.uint8,
+                      tile=(TILE, TILE),
+                      photometric="minisblack",
+                      compression="zlib",
+                      subfiletype=1,
+                      maxworkers=workers)
+
+
+def mask_levels(mask_f: str) -> list:
+    """Get the downsampling factors of the levels stored with a mask
+
+    Args:
+        mask_f (str): Path to the mask file
+
+    Returns:
+        list: Downsampling factor of each level, level 0 being the full resolution mask
+    """
+    with tifffile.TiffFile(mask_f) as tif:
+        return [1] + tif.shaped_metadata[0]["levels"]
+
+
+def mask_shape(mask_f: str, level: int = 0) -> tuple:
+    """Get the shape of a level of a mask without reading it
+
+    Args:
+        mask_f (str): Path to the mask file
+        level (int, optional): Level of the mask, 0 being the full resolution. Defaults to 0.
+
+    Returns:
+        tuple: The (height, width) shape of the level
+    """
+    return image_tiles.image_shape(mask_f, level)[:2]
+
+
+def read_mask(mask_f: str, window: tuple = None, level: int = 0) -> np.ndarray:
+    """Read a mask, or a window of it by decoding only the tiles overlapping the window
+
+    Args:
+        mask_f (str): Path to the mask file
+        window (tuple, optional): The (y0, y1, x0, x1) window in the coordinates of the level (None for the whole level). Defaults to None.
+        level (int, optional): Level of the mask, 0 being the full resolution. Defaults to 0.
+
+    Returns:
+        np.ndarray: The boolean mask for level 0, the uint8 area fractions for the downsampled levels
+    """
+    if window is None:
+        height, width = mask_shape(mask_f, level)
+        window = (0, height, 0, width)
+
+    return image_tiles.read_window(mask_f, *window, level=level)[..., 0]
+
+
+def iter_mask_bands(mask_f: str, height: int, level: int = 0):
+    """Read a mask as horizontal bands
+
+    Args:
+        mask_f (str): Path to the mask file
+        height (int): Number of rows of each band (the last band may be shorter)
+        level (int, optional): Level of the mask, 0 being the full resolution. Defaults to 0.
+
+    Yields:
+        tuple: The first row of the band and the (rows, width) band
+    """
+    for y, band in image_tiles.iter_bands(mask_f, height, level):
+        yield y, band[..., 0]
@@ -0,0 +1,45 @@
+import pandas as pd
+import shapely
+from shapely.geometry import shape
+import json
+import yaml
+import sys
+
+import pixel_index
+import pixel_store
+
+# Load the configuration file
+with open("config.yaml", "r") as file:
+    config = yaml.load(file, Loader=yaml.FullLoader)
+
+# Hyperparameters
+lame = sys.argv[1] if len(sys.argv) > 1 else config["lame"]  # Name of the lame (given by Snakemake or from the config)
+path = f"{config['path_to_data']}/{lame}/results"  # Path to the results folder
+
+# Get the warped geojson files of the microdissections, listed by microdissection_transfer.py
+with open(f"{path}/microdissections_warped.json", "r") as f:
+    warped_files = json.load(f)
+
+# Read the warped MALDI pixels and load their index, built once per slide
+pixels_f = f"{path}/{config['warped_annotation_file']}"
+pixels = pixel_store.read_pixels(pixels_f)
+index = pixel_index.get_index(f"{path}/pixels_maldi_index.npz", pixels_f)
+
+# Read the regions of the warped microdissections, named <microdissection>_<name of the annotation or its number>
+regions = {}
+for microdissection, warped_f in warped_files.items():
+    with open(warped_f, "r") as f:
+        features = json.load(f)["features"]
+    for i, feature in enumerate(features):
+        name = (feature.get("properties") or {}).get("name", i + 1)
+        regions[f"{microdissection}_{name}"] = shapely.make_valid(shape(feature["geometry"]))
+
+# Find the pixels of each region with the fraction of their area inside it
+overlaps = pixel_index.query_regions(index, pixels, regions)
+overlaps.to_csv(f"{path}/microdissections_pixels.csv", index=False)
+
+# Aggregate the densities of the pixels over each region
+pixels_df = pd.read_csv(f"{path}/pixels_maldi_warped_density_df.csv")
+summaries = pixel_index.region_summaries(overlaps, pixels_df)
+summaries.to_csv(f"{path}/microdissections_summary.csv", index=False)
+print(summaries)
@@ -1,21 +1,42 @@
 from valis import registration
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import traceback
 import json
 import yaml
+import sys
 import os
 
+from registration_cache import get_registrar
+import instrumentation
+
 # Load the configuration file
 with open("config.yaml", "r") as file:
     config = yaml.load(file, Loader=yaml.FullLoader)
 
 # Hyperparameters
-lame = config["lame"]  # Name of the lame
+lame = sys.argv[1] if len(sys.argv) > 1 else config["lame"]  # Name of the lame (given by Snakemake or from the config)
 path = f"{config['path_to_data']}/{lame}"  # Path to the data
 
 # Get the list of microdissections
 microdissections = [dir.split('_')[1] for dir in os.listdir(f"{path}/images") if "MDNF" in dir]
 
-for microdissection in microdissections:
-    
+# Record the time, memory and I/O of each microdissection if enabled
+# (the CPU time, peak RSS and I/O of the concurrent microdissections are those of the whole process)
+report = instrumentation.Report("microdissection_transfer", lame, config["instrumentation"])
+
+
+def transfer_microdissection(microdissection: str) -> str:
+    """Register a microdissection image on the HES slide and warp its annotation
+
+    Each microdissection has its own registration directory and warped geojson file,
+    the geojson being written to a temporary file renamed once complete.
+
+    Args:
+        microdissection (str): Name of the microdissection
+
+    Returns:
+        str: Path to the warped geojson file
+    """
     # Annotation and target images directory
     slide_src_dir = f"{path}/images/annotation_{microdissection}"
     # Alignment results directory
@@ -29,14 +50,13 @@ for microdissection in microdissections:
     # The warped features aligned to the target image as geojson file
     warped_geojson_annotation_f = f"{path}/results/{microdissection}_{config['warped_microdissection_file']}"
 
-    # Create a Valis object and use the target_img_file as reference
-    registrar = registration.Valis(src_dir=slide_src_dir,
-                                   dst_dir=results_dst_dir,
-                                   reference_img_f=target_img_f,
-                                   align_to_reference=config["align_to_reference"])
-
-    # Apply the registration
-    rigid_registrar, non_rigid_registrar, error_df = registrar.register()
+    # Register the slides using the target_img_file as reference, or load their registration from the cache
+    with report.span("registration", microdissection=microdissection):
+        registrar = get_registrar(src_dir=slide_src_dir,
+                                  dst_dir=results_dst_dir,
+                                  reference_img_f=target_img_f,
+                                  align_to_reference=config["align_to_reference"],
+                                  cache_dir=f"{path}/results/registration" if config["registration_cache"] else None)
 
     # Register the annotation source slide from the microdissection image
     annotation_source_slide = registrar.get_slide(src_f=annotation_img_f)
@@ -44,10 +64,50 @@ for microdissection in microdissections:
     target_slide = registrar.get_slide(src_f=target_img_f)
 
     # Transfer the annotation from microdissection image to HES.svs using the pixels.geojson file
-    warped_geojson = annotation_source_slide.warp_geojson_from_to(geojson_f=annotation_geojson_f,
-                                                                  to_slide_obj=target_slide,
-                                                                  non_rigid=config["microdissection_non_rigid"])
+    with report.span("warp", microdissection=microdissection):
+        warped_geojson = annotation_source_slide.warp_geojson_from_to(geojson_f=annotation_geojson_f,
+                                                                      to_slide_obj=target_slide,
+                                                                      non_rigid=config["microdissection_non_rigid"])
 
     # Save annotation as warped_pixels in the form geojson file, that can be dragged and dropped into QuPath
-    with open(warped_geojson_annotation_f, 'w') as f:
-        json.dump(warped_geojson, f)
\ No newline at end of file
+    with report.span("save", microdissection=microdissection):
+        with open(f"{warped_geojson_annotation_f}.tmp", 'w') as f:
+            json.dump(warped_geojson, f)
+        os.replace(f"{warped_geojson_annotation_f}.tmp", warped_geojson_annotation_f)
+
+    return warped_geojson_annotation_f
+
+
+# Start a single JVM shared by all the registrations
+registration.init_jvm()
+
+# Register the microdissections concurrently, a failure not stopping the others
+failures = {}
+try:
+    with ThreadPoolExecutor(max_workers=config["microdissection_workers"]) as executor:
+        futures = {executor.submit(transfer_microdissection, microdissection): microdissection
+                   for microdissection in microdissections}
+        for future in as_completed(futures):
+            microdissection = futures[future]
+            try:
+                print(f"{microdissection} transferred to {future.result()}")
+            except Exception:
+                failures[microdissection] = traceback.format_exc()
+                print(f"{microdissection} failed:\n{failures[microdissection]}")
+finally:
+    # Kill the JVM
+    registration.kill_jvm()
+
+    # Write the report of the stage, including the failed microdissections
+    report.write(f"{path}/results/reports/microdissection_transfer.json")
+
+# Raise an error listing the failed microdissections once all of them were processed
+if failures:
+    raise RuntimeError(f"The transfer failed for {len(failures)} of {len(microdissections)} microdissections: {', '.join(failures)}")
+
+# List the warped geojson files of the microdissections (the output of the stage), once all of them were transferred
+warped_f = f"{path}/results/microdissections_warped.json"
+with open(f"{warped_f}.tmp", 'w') as f:
+    json.dump({microdissection: f"{path}/results/{microdissection}_{config['warped_microdissection_file']}"
+               for microdissection in sorted(microdissections)}, f, indent=4)
+os.replace(f"{warped_f}.tmp", warped_f)
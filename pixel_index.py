@@ -0,0 +1,181 @@
+import os
+import numpy as np
+import pandas as pd
+import shapely
+
+import hashing
+import pixel_store
+
+
+def build_index(corners: np.ndarray, cell_size: float = None) -> dict:
+    """Build a uniform grid index of the bounds of the warped MALDI pixels
+
+    Each cell of the grid lists the pixels whose bounds overlap it, as a CSR structure:
+    the pixels of the cell c are indices[offsets[c]:offsets[c + 1]].
+
+    Args:
+        corners (np.ndarray): The (n_pixels, n_points, 2) x,y corners of the closed polygons of the pixels
+        cell_size (float, optional): Size of the cells (median size of the pixel bounds if None). Defaults to None.
+
+    Returns:
+        dict: The origin, cell_size, shape (rows, columns), offsets and indices of the grid
+    """
+    lower, upper = corners.min(axis=1), corners.max(axis=1)
+    if cell_size is None:
+        cell_size = float(np.median(upper - lower))
+    origin = lower.min(axis=0)
+
+    # Cells covered by the bounds of each pixel
+    first = np.floor((lower - origin) / cell_size).astype(np.int64)
+    last = np.floor((upper - origin) / cell_size).astype(np.int64)
+    columns, rows = last.max(axis=0) + 1
+    nx, ny = last[:, 0] - first[:, 0] + 1, last[:, 1] - first[:, 1] + 1
+
+    # Expand each pixel into its nx x ny cells at once
+    counts = nx * ny
+    pixel = np.repeat(np.arange(len(corners)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cx = first[pixel, 0] + local % nx[pixel]
+    cy = first[pixel, 1] + local // nx[pixel]
+    cell = cy * columns + cx
+
+    # Sort the pixels by cell
+    order = np.argsort(cell, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(cell, minlength=rows * columns))])
+
+    return {"origin": origin, "cell_size": np.float64(cell_size), "shape": np.array([rows, columns]),
+            "offsets": offsets, "indices": pixel[order].astype(np.int64)}
+
+
+def index_key(pixels_f: str) -> str:
+    """Identify an index by the content of the warped MALDI pixels file it was built from
+
+    Args:
+        pixels_f (str): Path to the warped MALDI pixels (see pixel_store)
+
+    Returns:
+        str: Hexadecimal hash of the pixels file
+    """
+    return hashing.file_hash(pixels_f)
+
+
+def get_index(index_f: str, pixels_f: str) -> dict:
+    """Load the index of the warped MALDI pixels of a slide, building and saving it if missing or outdated
+
+    Args:
+        index_f (str): Path to the index file (e.g. results/pixels_maldi_index.npz)
+        pixels_f (str): Path to the warped MALDI pixels (see pixel_store)
+
+    Returns:
+        dict: The grid index (see build_index)
+    """
+    key = index_key(pixels_f)
+
+    if os.path.exists(index_f):
+        with np.load(index_f) as saved:
+            if str(saved["key"]) == key:
+                return {name: saved[name] for name in saved.files if name != "key"}
+
+    print(f"Building the index of the MALDI pixels {index_f}")
+    index = build_index(pixel_store.read_pixels(pixels_f)["corners"])
+    np.savez(f"{index_f}.tmp.npz", key=key, **index)
+    os.replace(f"{index_f}.tmp.npz", index_f)
+
+    return index
+
+
+def candidates(index: dict, bounds: tuple) -> np.ndarray:
+    """List the pixels whose bounds may overlap a rectangle
+
+    Args:
+        index (dict): The grid index (see build_index)
+        bounds (tuple): The (xmin, ymin, xmax, ymax) rectangle
+
+    Returns:
+        np.ndarray: The sorted indices of the candidate pixels
+    """
+    rows, columns = index["shape"]
+    first = np.floor((np.array(bounds[:2]) - index["origin"]) / index["cell_size"]).astype(np.int64)
+    last = np.floor((np.array(bounds[2:]) - index["origin"]) / index["cell_size"]).astype(np.int64)
+    x0, y0 = np.maximum(first, 0)
+    x1, y1 = np.minimum(last, [columns - 1, rows - 1])
+    if x1 < x0 or y1 < y0:
+        return np.empty(0, dtype=np.int64)
+
+    cells = (np.arange(y0, y1 + 1)[:, np.newaxis] * columns + np.arange(x0, x1 + 1)).ravel()
+    return np.unique(np.concatenate([index["indices"][index["offsets"][c]:index["offsets"][c + 1]] for c in cells]))
+
+
+def query(index: dict, polygons: np.ndarray, region) -> tuple:
+    """Find the MALDI pixels overlapping a region and the fraction of their area inside it
+
+    Args:
+        index (dict): The grid index (see build_index)
+        polygons (np.ndarray): The shapely polygons of the pixels (e.g. shapely.polygons of their corners)
+        region (shapely.Geometry): The region (e.g. a warped microdissection)
+
+    Returns:
+        tuple: The indices of the pixels overlapping the region and the fraction of their area inside it
+    """
+    selected = candidates(index, region.bounds)
+    if len(selected) == 0:
+        return selected, np.empty(0)
+
+    # Compute the exact intersections of the candidates only
+    fractions = shapely.area(shapely.intersection(polygons[selected], region)) / shapely.area(polygons[selected])
+    inside = fractions > 0
+
+    return selected[inside], fractions[inside]
+
+
+def query_regions(index: dict, pixels: dict, regions: dict) -> pd.DataFrame:
+    """Find the MALDI pixels overlapping a set of regions
+
+    Args:
+        index (dict): The grid index (see build_index)
+        pixels (dict): The warped MALDI pixels (see pixel_store.read_pixels)
+        regions (dict): The shapely geometries of the regions by name
+
+    Returns:
+        pd.DataFrame: The region, the id of the pixel and the fraction of its area inside the region, for each overlap (empty without regions)
+    """
+    polygons = shapely.polygons(pixels["corners"])
+
+    overlaps = []
+    for name, region in regions.items():
+        selected, fractions = query(index, polygons, region)
+        overlaps.append(pd.DataFrame({"region": name, "id": pixels["id"][selected], "fraction": fractions}))
+
+    # A slide without regions (e.g. without microdissections) has no overlaps
+    if not overlaps:
+        return pd.DataFrame({"region": pd.Series(dtype=object),
+                             "id": pd.Series(dtype=pixels["id"].dtype),
+                             "fraction": pd.Series(dtype=float)})
+
+    return pd.concat(overlaps, ignore_index=True)
+
+
+def region_summaries(overlaps: pd.DataFrame, pixels_df: pd.DataFrame) -> pd.DataFrame:
+    """Aggregate the densities of the MALDI pixels over each region, weighted by the fraction of the pixels inside it
+
+    Args:
+        overlaps (pd.DataFrame): The overlaps of the regions and the pixels (see query_regions)
+        pixels_df (pd.DataFrame): The pixels with their id and Density_<marker> columns (e.g. pixels_maldi_warped_density_df.csv)
+
+    Returns:
+        pd.DataFrame: For each region, the number of spectra, the area covered in MALDI pixels and the weighted mean density of each marker
+    """
+    columns = [column for column in pixels_df.columns if column.startswith("Density_")]
+    merged = overlaps.merge(pixels_df[["id"] + columns], on="id", how="left")
+
+    # Weight the densities by the fractions, ignoring the pixels without density
+    weights = merged[columns].notna().mul(merged["fraction"], axis=0)
+    weighted = merged[columns].fillna(0).mul(merged["fraction"], axis=0)
+    grouped = merged.assign(**{f"{column}_sum": weighted[column] for column in columns},
+                            **{f"{column}_weight": weights[column] for column in columns}).groupby("region")
+
+    summaries = pd.DataFrame({"spectra": grouped["id"].count(), "area": grouped["fraction"].sum()})
+    for column in columns:
+        summaries[column] = grouped[f"{column}_sum"].sum() / grouped[f"{column}_weight"].sum()
+
+    return summaries.reset_index()
@@ -0,0 +1,96 @@
+import os
+import numpy as np
+import tifffile
+from skimage.draw import polygon
+
+import hashing
+import mask_store
+
+
+def rasterise_band(corners: np.ndarray, y0: int, y1: int, width: int) -> np.ndarray:
+    """Rasterise the polygons of the MALDI pixels into the rows y0 to y1 of a label image
+
+    A mask pixel gets the label of the polygon containing its coordinates, the label of
+    the polygon i being i + 1 (0 outside the polygons, the last polygon winning on overlaps).
+
+    Args:
+        corners (np.ndarray): The (n_pixels, n_points, 2) x,y corners of the closed polygons in mask pixels
+        y0 (int): First row of the band
+        y1 (int): Row after the last row of the band
+        width (int): Width of the label image
+
+    Returns:
+        np.ndarray: The (y1 - y0, width) uint32 labels
+    """
+    labels = np.zeros((y1 - y0, width), dtype=np.uint32)
+
+    # Rasterise only the polygons crossing the band
+    ys = corners[:, :, 1]
+    for i in np.flatnonzero((ys.max(axis=1) >= y0) & (ys.min(axis=1) < y1)):
+        rr, cc = polygon(ys[i] - y0, corners[i, :, 0], shape=labels.shape)
+        labels[rr, cc] = i + 1
+
+    return labels
+
+
+def labels_key(pixels_f: str, shape: tuple) -> str:
+    """Identify a label image by the MALDI pixels it was rasterised from and its shape
+
+    Args:
+        pixels_f (str): Path to the warped MALDI pixels (see pixel_store)
+        shape (tuple): The (height, width) of the label image
+
+    Returns:
+        str: Hexadecimal hash of the pixels file content and the shape
+    """
+    return hashing.params_hash({"pixels": hashing.file_hash(pixels_f), "shape": list(shape)})
+
+
+def write_labels(labels_f: str, corners: np.ndarray, shape: tuple, key: str, workers: int = None) -> None:
+    """Rasterise the polygons of the MALDI pixels into a tiled and compressed label image, band by band
+
+    Args:
+        labels_f (str): Path to the label image (e.g. results/pixels_maldi_labels.tiff)
+        corners (np.ndarray): The (n_pixels, n_points, 2) x,y corners of the closed polygons in mask pixels
+        shape (tuple): The (height, width) of the masks
+        key (str): Key of the pixels and shape (see labels_key)
+        workers (int, optional): Number of threads compressing the tiles (None: chosen by tifffile). Defaults to None.
+    """
+    height, width = shape
+    bands = (rasterise_band(corners, y, min(height, y + mask_store.TILE), width) for y in range(0, height, mask_store.TILE))
+
+    with tifffile.TiffWriter(f"{labels_f}.tmp", bigtiff=True) as tif:
+        tif.write(mask_store.iter_tiles(bands, width),
+                  shape=(height, width),
+                  dtype=np.uint32,
+                  tile=(mask_store.TILE, mask_store.TILE),
+                  photometric="minisblack",
+                  compression="zlib",
+                  maxworkers=workers,
+                  metadata={"key": key})
+    os.replace(f"{labels_f}.tmp", labels_f)
+
+
+def get_labels(labels_f: str, pixels_f: str, corners: np.ndarray, shape: tuple) -> str:
+    """Get the label image of the MALDI pixels, rasterising it only if it is missing or outdated
+
+    Args:
+        labels_f (str): Path to the label image
+        pixels_f (str): Path to the warped MALDI pixels (see pixel_store)
+        corners (np.ndarray): The corners of the warped MALDI pixels read from pixels_f
+        shape (tuple): The (height, width) of the masks
+
+    Returns:
+        str: Path to the up to date label image
+    """
+    key = labels_key(pixels_f, shape)
+
+    if os.path.exists(labels_f):
+        with tifffile.TiffFile(labels_f) as tif:
+            if tif.shaped_metadata[0].get("key") == key:
+                return labels_f
+
+    print(f"Rasterising the MALDI pixels into {labels_f}")
+    write_labels(labels_f, corners, shape, key)
+
+    return labels_f
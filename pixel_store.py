@@ -0,0 +1,141 @@
+import os
+import numpy as np
+
+
+def pixel_size(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Compute the size of the pixels of a regular grid from the distance between their centers
+
+    Args:
+        x (np.ndarray): x coordinates of the pixel centers
+        y (np.ndarray): y coordinates of the pixel centers
+
+    Returns:
+        np.ndarray: The (width, height) of the pixels, the smallest distance between two distinct x and y
+    """
+    edges_x = np.unique(np.round(np.diff(np.sort(np.unique(x))), 6))
+    edges_y = np.unique(np.round(np.diff(np.sort(np.unique(y))), 6))
+
+    return np.array([edges_x[0], edges_y[0]])
+
+
+def pixel_corners(x: np.ndarray, y: np.ndarray, size: np.ndarray) -> np.ndarray:
+    """Compute the closed square polygons of the pixels
+
+    Args:
+        x (np.ndarray): x coordinates of the pixel centers
+        y (np.ndarray): y coordinates of the pixel centers
+        size (np.ndarray): The (width, height) of the pixels
+
+    Returns:
+        np.ndarray: The (n_pixels, 5, 2) corners of the pixels, the first corner being repeated at the end
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    lx, ly = size[0] / 2, size[1] / 2
+
+    return np.stack([np.stack([x - lx, y - ly], axis=1),
+                     np.stack([x - lx, y + ly], axis=1),
+                     np.stack([x + lx, y + ly], axis=1),
+                     np.stack([x + lx, y - ly], axis=1),
+                     np.stack([x - lx, y - ly], axis=1)], axis=1)
+
+
+def polygon_centroids(polygons: np.ndarray) -> np.ndarray:
+    """Compute the area centroids of closed polygons, as shapely does
+
+    Args:
+        polygons (np.ndarray): The (n_polygons, n_points, 2) coordinates of the closed polygons
+
+    Returns:
+        np.ndarray: The (n_polygons, 2) centroids
+    """
+    # Shift the polygons to their first point for the precision of the cross products
+    origin = polygons[:, :1]
+    points = polygons - origin
+    x0, y0, x1, y1 = points[:, :-1, 0], points[:, :-1, 1], points[:, 1:, 0], points[:, 1:, 1]
+
+    # Shoelace formula
+    cross = x0 * y1 - x1 * y0
+    area = cross.sum(axis=1) / 2
+    cx = ((x0 + x1) * cross).sum(axis=1) / (6 * area)
+    cy = ((y0 + y1) * cross).sum(axis=1) / (6 * area)
+
+    return np.stack([cx, cy], axis=1) + origin[:, 0]
+
+
+def write_pixels(pixels_f: str, x: np.ndarray, y: np.ndarray, size: np.ndarray, ids: np.ndarray = None, corners: np.ndarray = None) -> None:
+    """Write the MALDI pixels as columnar arrays in a .npz file
+
+    Args:
+        pixels_f (str): Path to the .npz file
+        x (np.ndarray): x coordinates of the pixel centers
+        y (np.ndarray): y coordinates of the pixel centers
+        size (np.ndarray): The (width, height) of the pixels before any warping
+        ids (np.ndarray, optional): Ids of the pixels (1, 2, ... if None). Defaults to None.
+        corners (np.ndarray, optional): The (n_pixels, 5, 2) corners of the warped pixels (squares of the given size if None). Defaults to None.
+    """
+    arrays = {"id": np.arange(1, len(x) + 1, dtype=np.int32) if ids is None else np.asarray(ids, dtype=np.int32),
+              "x": np.asarray(x, dtype=float),
+              "y": np.asarray(y, dtype=float),
+              "size": np.asarray(size, dtype=float)}
+    if corners is not None:
+        arrays["corners"] = np.asarray(corners, dtype=float)
+
+    # Write to a temporary file renamed once complete (np.savez adds the extension to the name)
+    np.savez(f"{pixels_f}.tmp.npz", **arrays)
+    os.replace(f"{pixels_f}.tmp.npz", pixels_f)
+
+
+def read_pixels(pixels_f: str) -> dict:
+    """Read the MALDI pixels written by write_pixels
+
+    Args:
+        pixels_f (str): Path to the .npz file
+
+    Returns:
+        dict: The id, x, y, size and corners arrays of the pixels (corners computed from the size if not stored)
+    """
+    with np.load(pixels_f) as data:
+        pixels = {key: data[key] for key in data.files}
+    if "corners" not in pixels:
+        pixels["corners"] = pixel_corners(pixels["x"], pixels["y"], pixels["size"])
+
+    return pixels
+
+
+def write_feature_collection(f, polygons: np.ndarray, object_type: str, chunk_size: int = 10000) -> None:
+    """Stream polygons to a text file as a geojson FeatureCollection, chunk by chunk
+
+    The features are written as geojson.dumps would write them, with the ids "1", "2", ...
+    and without building a Python object for each polygon
+
+    Args:
+        f (file): The opened text file
+        polygons (np.ndarray): The (n_polygons, n_points, 2) coordinates of the closed polygons
+        object_type (str): The objectType property of the features
+        chunk_size (int, optional): Number of features formatted at once. Defaults to 10000.
+    """
+    f.write('{"type": "FeatureCollection", "features": [')
+    for start in range(0, len(polygons), chunk_size):
+        # Separate the chunk from the previous one
+        if start > 0:
+            f.write(", ")
+
+        # Format the features of the chunk (the str of a list of floats is its json)
+        f.write(", ".join(f'{{"type": "Feature", "id": "{start + i + 1}", '
+                          f'"geometry": {{"type": "Polygon", "coordinates": [{polygon}]}}, '
+                          f'"properties": {{"objectType": "{object_type}"}}}}'
+                          for i, polygon in enumerate(polygons[start:start + chunk_size].tolist())))
+    f.write("]}")
+
+
+def write_geojson(geojson_f: str, polygons: np.ndarray, object_type: str = "pixel") -> None:
+    """Write polygons as a geojson file that can be dragged and dropped into QuPath
+
+    Args:
+        geojson_f (str): Path to the geojson file
+        polygons (np.ndarray): The (n_polygons, n_points, 2) coordinates of the closed polygons
+        object_type (str, optional): The objectType property of the features. Defaults to "pixel".
+    """
+    with open(geojson_f, "w") as f:
+        # Round the coordinates as geojson does
+        write_feature_collection(f, np.round(polygons, 6), object_type=object_type)
@@ -1,45 +1,49 @@
 # Libraries
-import pandas as pd
 import matplotlib.pyplot as plt
-import m2aia as m2
 import yaml
+import sys
 import os
 
 # Functions
-from utils import extract_contour, countour_to_geojson, align_coord_contour, coord_to_geojson
+from utils import extract_contour, countour_to_geojson, align_coord_contour, read_imzml_positions
+import instrumentation
+import pixel_store
 
 # Load the configuration file
 with open('config.yaml', 'r') as file:
     config = yaml.load(file, Loader=yaml.FullLoader)
 
 # Hyperparameters
-lame = config['lame']
+lame = sys.argv[1] if len(sys.argv) > 1 else config['lame']  # Name of the lame (given by Snakemake or from the config)
 
 path = f"{config['path_to_data']}/{lame}"
 
+# Record the time, memory and I/O of each step if enabled
+report = instrumentation.Report("pixels_geojson", lame, config['instrumentation'])
+
 # Read the mis file
-with open(f"{path}/maldi/mse.mis") as f:
-    mis = f.read()
+with report.span("contour"):
+    with open(f"{path}/maldi/mse.mis") as f:
+        mis = f.read()
 
-# Extract the x,y coordinates from the mis file
-contour = extract_contour(mis)
+    # Extract the x,y coordinates from the mis file
+    contour = extract_contour(mis)
 
 # transform the coordinates to geojson
-geojson_contour = countour_to_geojson(contour=contour,
-                                      save=True,
-                                      name=f"{path}/results/contour")
-
-# Read the MALDI-MSI spectrum
-imzml = m2.ImzMLReader(imzML_path=f"{path}/maldi/mse.imzML")
+countour_to_geojson(contour=contour,
+                    save=True,
+                    name=f"{path}/results/contour",
+                    return_geojson=False)
 
-# Extract the x,y coordinates from the imzml file
-coord_imzml = pd.DataFrame(data=[imzml.GetSpectrumPosition(id=i)[:2] for i in range(imzml.number_of_spectra)],
-                           columns=['x', 'y'])
+# Stream the x,y coordinates of the spectra from the imzML file, without reading the spectra
+with report.span("positions"):
+    coord_imzml = read_imzml_positions(f"{path}/maldi/mse.imzML")
 
 # Align the MALDI-MSI spectrum x,y coordinates with the MALDI image contour
-coord_maldi = align_coord_contour(coord=coord_imzml[['x', 'y']].values,
-                                  contour=contour,
-                                  conserve_dimensions=False)
+with report.span("alignment"):
+    coord_maldi = align_coord_contour(coord=coord_imzml,
+                                      contour=contour,
+                                      conserve_dimensions=False)
 
 # Plot the MALDI-MSI spectrum x,y coordinates and the MALDI image contour
 if config['plot_pixels_and_contour']:
@@ -64,8 +68,16 @@ if config['plot_pixels_and_contour']:
     plt.savefig(f"{path}/results/figures/coord_maldi.png")
     plt.close()
 
-# Transform the x,y coordinates into pixels in the form of geojson text
-geojson = coord_to_geojson(x_coord=coord_maldi[:, 0],
-                           y_coord=coord_maldi[:, 1],
-                           save=True,
-                           name=f"{path}/results/pixels_maldi")
+# Save the x,y coordinates of the pixels and their size as columnar arrays
+pixels_f = f"{path}/results/{config['annotation_file']}"
+with report.span("save"):
+    size = pixel_store.pixel_size(coord_maldi[:, 0], coord_maldi[:, 1])
+    pixel_store.write_pixels(pixels_f, x=coord_maldi[:, 0], y=coord_maldi[:, 1], size=size)
+
+    # Save the pixels as a geojson file that can be dragged and dropped into QuPath
+    if config['qupath_geojson']:
+        pixel_store.write_geojson(f"{os.path.splitext(pixels_f)[0]}.geojson",
+                                  pixel_store.pixel_corners(coord_maldi[:, 0], coord_maldi[:, 1], size))
+
+# Write the report of the stage
+report.write(f"{path}/results/reports/pixels_geojson.json")
@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import tifffile
+
+import image_tiles
+import mask_store
+
+# Approximate number of bytes held in memory per pixel while the probabilities are thresholded:
+# the uint8 probabilities and the boolean mask
+BYTES_PER_PIXEL = 2
+
+
+def write_probabilities(probs_f: str, probs: np.ndarray, key: str, workers: int = None) -> None:
+    """Save quantised probabilities as a tiled and compressed TIFF identified by a key
+
+    The probabilities are read tile row by tile row, so they can be a memory mapped file.
+    The file is written under a temporary name and renamed once complete.
+
+    Args:
+        probs_f (str): Path to the probabilities file (e.g. results/probabilities/<marker>_probabilities.tiff)
+        probs (np.ndarray): The (height, width) uint8 quantised probabilities
+        key (str): Key of the inputs of the probabilities (e.g. the hash of the image and the model)
+        workers (int, optional): Number of threads compressing the tiles (None: chosen by tifffile). Defaults to None.
+    """
+    height, width = probs.shape
+    os.makedirs(os.path.dirname(probs_f), exist_ok=True)
+
+    with tifffile.TiffWriter(f"{probs_f}.tmp", bigtiff=True) as tif:
+        tif.write(mask_store.iter_tiles((probs[y:y + mask_store.TILE] for y in range(0, height, mask_store.TILE)), width),
+                  shape=(height, width),
+                  dtype=np.uint8,
+                  tile=(mask_store.TILE, mask_store.TILE),
+                  photometric="minisblack",
+                  compression="zlib",
+                  maxworkers=workers,
+                  metadata={"key": key})
+    os.replace(f"{probs_f}.tmp", probs_f)
+
+
+def probabilities_key(probs_f: str) -> str:
+    """Get the key of saved probabilities without reading them
+
+    Args:
+        probs_f (str): Path to the probabilities file
+
+    Returns:
+        str: The key given to write_probabilities (None if the file does not exist)
+    """
+    if not os.path.exists(probs_f):
+        return None
+
+    with tifffile.TiffFile(probs_f) as tif:
+        return tif.shaped_metadata[0].get("key")
+
+
+def iter_probability_bands(probs_f: str, height: int):
+    """Read saved probabilities as horizontal bands
+
+    Args:
+        probs_f (str): Path to the probabilities file
+        height (int): Number of rows of each band (the last band may be shorter)
+
+    Yields:
+        tuple: The first row of the band and the (rows, width) uint8 band
+    """
+    for y, band in image_tiles.iter_bands(probs_f, height):
+        yield y, band[..., 0]
@@ -0,0 +1,114 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+
+def export_tiles(path_qp: str, marker: str) -> list:
+    """List the tiles of a marker mask exported from the QuPath project
+
+    Args:
+        path_qp (str): Path to the export directory of the QuPath project
+        marker (str): Name of the marker
+
+    Returns:
+        list: Paths to the <marker>_mask_i_of_N.png tiles, from left to right
+    """
+    # Determine the number of tiles
+    num_of_tiles = len([tile for tile in os.listdir(path_qp) if marker in tile])
+
+    return [f"{path_qp}/{marker}_mask_{i}_of_{num_of_tiles}.png" for i in range(1, num_of_tiles + 1)]
+
+
+def read_green(tile_f: str) -> np.ndarray:
+    """Read the green channel of an exported tile, in which QuPath paints the annotations
+
+    Args:
+        tile_f (str): Path to the tile
+
+    Returns:
+        np.ndarray: The (rows, columns) uint8 green channel
+    """
+    # scikit-image is imported only when a mask is assembled, listing the tiles does not need it
+    from skimage import io
+
+    return io.imread(tile_f)[:, :, 1]
+
+
+def histogram_threshold(hist: np.ndarray) -> float:
+    """Compute the isodata threshold of a uint8 image from its histogram
+
+    It gives the same threshold as threshold_isodata applied on the image itself.
+
+    Args:
+        hist (np.ndarray): The 256 counts of the values of the image
+
+    Returns:
+        float: The isodata threshold
+    """
+    # Restrict the histogram to the range of the image values
+    values = np.flatnonzero(hist)
+    counts = hist[values[0]:values[-1] + 1]
+
+    from skimage.filters import threshold_isodata
+
+    return threshold_isodata(hist=(counts, np.arange(values[0], values[-1] + 1)))
+
+
+def assemble_mask(tiles: list, width: int, out_f: str = None, workers: int = None) -> tuple:
+    """Assemble the binary mask of the exported tiles, decoding each tile only once
+
+    The tiles are decoded concurrently and their green channel written directly at their
+    column offset in the output while the histogram of the whole export is accumulated.
+    The isodata threshold of this global histogram is then applied in place, and the
+    columns after the last tile are filled with the last column (as np.pad with mode='edge').
+
+    Args:
+        tiles (list): Paths to the tiles, from left to right
+        width (int): Width of the original image
+        out_f (str, optional): Path to a .npy file in which the mask is memory mapped (in memory if None). Defaults to None.
+        workers (int, optional): Number of tiles decoded concurrently (None: chosen by ThreadPoolExecutor). Defaults to None.
+
+    Returns:
+        tuple: The (height, width) boolean mask and the threshold on the green channel
+    """
+    # Read the sizes of the tiles from their headers to compute their column offsets
+    sizes = []
+    for tile_f in tiles:
+        with Image.open(tile_f) as tile:
+            sizes.append(tile.size)
+    offsets = np.cumsum([0] + [tile_width for tile_width, _ in sizes])
+    if offsets[-1] > width:
+        raise ValueError(f"The tiles are {offsets[-1]} pixels wide, more than the original image ({width} pixels)")
+
+    # Allocate the mask of the original image size, first used to hold the green channel
+    if out_f is None:
+        mask = np.empty((sizes[0][1], width), dtype=bool)
+    else:
+        mask = np.lib.format.open_memmap(out_f, mode="w+", dtype=bool, shape=(sizes[0][1], width))
+    green = mask.view(np.uint8)
+
+    # Decode each tile, write its green channel at its offset and count its values
+    def read_tile(i):
+        tile = read_green(tiles[i])
+        green[:, offsets[i]:offsets[i + 1]] = tile
+        return np.bincount(tile.ravel(), minlength=256)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hist = sum(executor.map(read_tile, range(len(tiles))))
+
+        # Compute the threshold of the whole export
+        thresh = histogram_threshold(hist)
+        if hist[:int(np.ceil(thresh))].sum() == 0:
+            raise ValueError(f"The threshold {thresh} does not isolate the signal of the tiles")
+
+        # Threshold the green channel in place, the darker pixels being in the mask
+        def threshold_tile(i):
+            np.less(green[:, offsets[i]:offsets[i + 1]], thresh, out=mask[:, offsets[i]:offsets[i + 1]])
+
+        list(executor.map(threshold_tile, range(len(tiles))))
+
+    # Complete the mask to meet the original image size
+    mask[:, offsets[-1]:] = mask[:, offsets[-1] - 1:offsets[-1]]
+
+    return mask, thresh
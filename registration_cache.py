@@ -0,0 +1,89 @@
+import os
+import json
+import pickle
+import valis
+from valis import registration
+
+import hashing
+import manifest
+
+
+def registration_key(src_dir: str, reference_img_f: str, align_to_reference: bool, manifest_f: str = None) -> str:
+    """Identify a registration by the content of its slides and its options
+
+    Args:
+        src_dir (str): Directory of the slides to register
+        reference_img_f (str): The reference image to which the slides are aligned
+        align_to_reference (bool): Whether all the slides are aligned directly to the reference
+        manifest_f (str, optional): Manifest memoising the hashes of the slides by their size and modification time,
+                                    so that the slides are hashed again only if they changed (see manifest.file_hash). Defaults to None.
+
+    Returns:
+        str: Hexadecimal hash of the slides contents, the options and the VALIS version
+    """
+    slides_f = [slide_f for slide_f in sorted(os.listdir(src_dir)) if os.path.isfile(f"{src_dir}/{slide_f}")]
+    if manifest_f is not None:
+        hashes = manifest.read_manifest(manifest_f)
+        slides = {slide_f: manifest.file_hash(hashes, f"{src_dir}/{slide_f}") for slide_f in slides_f}
+        manifest.update_manifest(manifest_f, files=hashes["files"])
+    else:
+        slides = {slide_f: hashing.file_hash(f"{src_dir}/{slide_f}") for slide_f in slides_f}
+
+    return hashing.params_hash({"slides": slides,
+                                "reference": os.path.basename(reference_img_f),
+                                "align_to_reference": align_to_reference,
+                                "valis": getattr(valis, "__version__", None)})
+
+
+def get_registrar(src_dir: str, dst_dir: str, reference_img_f: str, align_to_reference: bool, cache_dir: str = None) -> registration.Valis:
+    """Get the fitted VALIS registrar of the slides, loading it from the cache when available
+
+    The registrar is pickled under cache_dir/<key>/registrar.pickle after the registration,
+    the key being the hash of the slides contents and the registration options.
+    Later stages and re-runs with the same slides and options load it instead of registering again.
+    The hashes of the slides are memoised in cache_dir/manifest.json, and the cache files are written
+    to temporary files renamed once complete, so that an interrupted job leaves no partial registrar.
+
+    Args:
+        src_dir (str): Directory of the slides to register
+        dst_dir (str): Directory of the VALIS registration results
+        reference_img_f (str): The reference image to which the slides are aligned
+        align_to_reference (bool): Whether all the slides are aligned directly to the reference
+        cache_dir (str, optional): Directory of the registration cache (no cache if None). Defaults to None.
+
+    Returns:
+        registration.Valis: The fitted registrar
+    """
+    if cache_dir is not None:
+        # Look for a registrar of the same slides and options
+        key = registration_key(src_dir, reference_img_f, align_to_reference, manifest_f=f"{cache_dir}/manifest.json")
+        registrar_f = f"{cache_dir}/{key}/registrar.pickle"
+        if os.path.exists(registrar_f):
+            print(f"Loading the registration of {src_dir} from {registrar_f}")
+            return registration.load_registrar(registrar_f)
+
+    # Create a Valis object and use it to register the slides in src_dir
+    registrar = registration.Valis(src_dir=src_dir,
+                                   dst_dir=dst_dir,
+                                   reference_img_f=reference_img_f,
+                                   align_to_reference=align_to_reference)
+
+    # Apply the registration
+    registrar.register()
+
+    if cache_dir is not None:
+        # Save the fitted registrar with a description of its inputs
+        os.makedirs(f"{cache_dir}/{key}", exist_ok=True)
+        description_f = f"{cache_dir}/{key}/registration.json"
+        with open(f"{description_f}.{os.getpid()}.tmp", "w") as f:
+            json.dump({"src_dir": src_dir,
+                       "reference_img_f": reference_img_f,
+                       "align_to_reference": align_to_reference}, f, indent=4)
+        os.replace(f"{description_f}.{os.getpid()}.tmp", description_f)
+
+        # The registrar is renamed last, its existence marking a complete cache entry
+        with open(f"{registrar_f}.{os.getpid()}.tmp", "wb") as f:
+            pickle.dump(registrar, f)
+        os.replace(f"{registrar_f}.{os.getpid()}.tmp", registrar_f)
+
+    return registrar
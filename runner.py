@@ -0,0 +1,41 @@
+import argparse
+import importlib
+import yaml
+
+from array_cache import ArrayCache
+
+# Stages run in a single process, in the order of the pipeline, each module exposing run(lame, config, cache)
+STAGES = ["mask_generation", "mask_generation_microdissection", "mask_densities"]
+
+
+def run_stages(lames: list, stages: list, config: dict) -> None:
+    """Run stages of the pipeline on slides in the current process
+
+    The configuration is read once, the module of a stage (and its heavy libraries) is imported
+    only when the stage runs, and the decoded arrays (e.g. the masks kept in memory by the mask
+    generation for the densities) are shared between the stages through a bounded cache.
+
+    Args:
+        lames (list): Names of the slides
+        stages (list): Names of the stages, run in this order on each slide
+        config (dict): The configuration (config.yaml)
+    """
+    cache = ArrayCache(memory_budget=config["cache_memory_budget"])
+
+    for lame in lames:
+        for stage in stages:
+            print(f"Running {stage} on {lame}")
+            importlib.import_module(stage).run(lame, config, cache)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the mask and density stages of slides in a single Python process")
+    parser.add_argument("lames", nargs="*", help="Names of the slides (the lame of config.yaml if none)")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="Stages to run, in the order of the pipeline")
+    args = parser.parse_args()
+
+    # Load the configuration file
+    with open("config.yaml", "r") as stream:
+        config = yaml.safe_load(stream)
+
+    run_stages(args.lames or [config["lame"]], [stage for stage in STAGES if stage in args.stages], config)
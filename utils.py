@@ -1,7 +1,23 @@
+from __future__ import annotations
+
+import io
+import re
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import TYPE_CHECKING
 import numpy as np
-import geopandas as gpd
-from geojson import Polygon, Feature, FeatureCollection, dumps
-import m2aia as m2
+from geojson import Polygon
+
+from pixel_store import pixel_size, pixel_corners, write_feature_collection
+
+# m2aia (and its container) is only needed by the readers of the spectra, not to read the positions
+if TYPE_CHECKING:
+    import m2aia as m2
+
+# Accessions of the position cvParams of the spectra in the imzML files
+POSITION_X = 'IMS:1000050'
+POSITION_Y = 'IMS:1000051'
 
 
 def central_mz_feature(imzml: m2.ImageIO.ImzMLReader, coordinates: np.ndarray, center: float, tolerance: float) -> np.ndarray:
@@ -20,9 +36,94 @@ def central_mz_feature(imzml: m2.ImageIO.ImzMLReader, coordinates: np.ndarray, c
     image = imzml.GetArray(center, tolerance, squeeze=True)
     
     # Transform the image into a feature
-    feature = [image[y, x] for x, y in coordinates]
+    coordinates = np.asarray(coordinates)
+    return image[coordinates[:, 1], coordinates[:, 0]]
+
+
+def pool_windows(mzs: np.ndarray, intensities: np.ndarray, lower: np.ndarray, upper: np.ndarray, pooling: str = 'maximum') -> np.ndarray:
+    """Pool the intensities of a spectrum in several m/z windows at once
+
+    Args:
+        mzs (np.ndarray): Sorted m/z values of the spectrum
+        intensities (np.ndarray): Intensities of the spectrum
+        lower (np.ndarray): Lower m/z bound of each window (included)
+        upper (np.ndarray): Upper m/z bound of each window (included)
+        pooling (str, optional): Pooling of the intensities in a window ('maximum', 'sum' or 'mean'). Defaults to 'maximum'.
+
+    Returns:
+        np.ndarray: Pooled intensity of each window (0 for the windows without any m/z value)
+    """
+    # Find the range of the m/z values of each window
+    start = np.searchsorted(mzs, lower, side='left')
+    stop = np.searchsorted(mzs, upper, side='right')
+    counts = stop - start
+
+    if pooling == 'maximum':
+        # Reduce the intensities between the interleaved starts and stops (padded to allow a stop at the end)
+        bounds = np.stack([start, stop], axis=1).ravel()
+        pooled = np.maximum.reduceat(np.append(intensities, 0), bounds)[::2]
+    elif pooling in ('sum', 'mean'):
+        # Difference of the cumulative sums at the bounds
+        cumsum = np.concatenate([[0], np.cumsum(intensities, dtype=np.float64)])
+        pooled = cumsum[stop] - cumsum[start]
+        if pooling == 'mean':
+            pooled = pooled / np.maximum(counts, 1)
+    else:
+        raise ValueError(f"Pooling {pooling} not recognized")
+
+    return np.where(counts > 0, pooled, 0)
+
+
+def central_mz_features(imzml: m2.ImageIO.ImzMLReader, coordinates: np.ndarray, centers: np.ndarray, tolerances, pooling: str = 'maximum', workers: int = 1, chunk_size: int = 64, block_size: int = 1024) -> np.ndarray:
+    """Get the m/z features of the coordinates in the MSI array image around several central m/z values
+
+    Unlike calling central_mz_feature for each m/z value, which reads all the spectra for each of them,
+    the spectra are read only once and all the m/z windows are pooled from each spectrum.
+
+    Args:
+        imzml (m2aia.ImageIO.ImzMLReader): Wrapper class for M2aia's imzML reader
+        coordinates (np.ndarray): Coordinates of the spectrums pixels on the image
+        centers (np.ndarray): Central m/z values of the features
+        tolerances (np.ndarray or float): Tolerance of each feature (or a single one for all) for the m/z values to be considered
+        pooling (str, optional): Pooling of the intensities in a window ('maximum', 'sum' or 'mean'), it should match the pooling of the imzML reader. Defaults to 'maximum'.
+        workers (int, optional): Number of threads pooling chunks of m/z windows concurrently. Defaults to 1.
+        chunk_size (int, optional): Number of m/z windows in each chunk given to a worker. Defaults to 64.
+        block_size (int, optional): Number of spectra read before their windows are pooled. Defaults to 1024.
 
-    return np.array(feature)
+    Returns:
+        np.ndarray: The (n_pixels, n_features) features of the m/z values in the coordinates
+    """
+    # Bounds of the m/z windows
+    centers = np.asarray(centers, dtype=np.float64)
+    tolerances = np.broadcast_to(np.asarray(tolerances, dtype=np.float64), centers.shape)
+    lower, upper = centers - tolerances, centers + tolerances
+    chunks = [slice(start, start + chunk_size) for start in range(0, len(centers), chunk_size)]
+
+    # Features of each spectrum with an extra row of zeros for the pixels without spectrum
+    features = np.zeros((imzml.number_of_spectra + 1, len(centers)), dtype=np.float32)
+    positions = np.zeros((imzml.number_of_spectra, 2), dtype=np.int64)
+
+    # Pool a chunk of windows from a block of spectra
+    def pool_chunk(block, chunk):
+        for i, mzs, intensities in block:
+            features[i, chunk] = pool_windows(mzs, intensities, lower[chunk], upper[chunk], pooling)
+
+    # Read each spectrum once, by blocks, and pool all the windows from the block
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, imzml.number_of_spectra, block_size):
+            block = []
+            for i in range(start, min(start + block_size, imzml.number_of_spectra)):
+                block.append((i, *imzml.GetSpectrum(i)))
+                positions[i] = imzml.GetSpectrumPosition(i)[:2]
+            list(executor.map(partial(pool_chunk, block), chunks))
+
+    # Map the image positions to the spectra
+    index = np.full(positions.max(axis=0)[::-1] + 1, imzml.number_of_spectra)
+    index[positions[:, 1], positions[:, 0]] = np.arange(imzml.number_of_spectra)
+
+    # Gather the features of the coordinates
+    coordinates = np.asarray(coordinates)
+    return features[index[coordinates[:, 1], coordinates[:, 0]]]
 
 
 def extract_contour(mis: str) -> np.array:
@@ -34,53 +135,150 @@ def extract_contour(mis: str) -> np.array:
     Returns:
         coordinates: A numpy array containing the x,y coordinates of the contour
     """
-    # Split the mis file by line
-    mis = mis.splitlines()
+    # Extract the x,y coordinates between the '<Point>' tags starting the lines of the mis file at once
+    points = re.findall(r'^<Point>\s*(-?\d+)\s*,\s*(-?\d+)\s*<', mis, flags=re.MULTILINE)
+
+    # Transform the points into a numpy array of integers
+    return np.array(points, dtype=np.int64)
+
+
+def read_imzml_positions(imzml_f: str) -> np.ndarray:
+    """Read the x,y positions of the spectra by streaming the XML of the imzML file
+
+    The 'position x' and 'position y' cvParams of each spectrum are collected while the file is parsed,
+    each spectrum element being cleared once read, so that neither the spectra nor the XML tree are loaded.
+
+    Args:
+        imzml_f (str): Path to the imzML file
+
+    Returns:
+        np.ndarray: The (n_spectra, 2) integer x,y positions, in the order of the spectra
+    """
+    x, y = [], []
+    position = {}
+    for _, element in ElementTree.iterparse(imzml_f, events=('end',)):
+        # Remove the namespace of the tag
+        tag = element.tag.rpartition('}')[2]
+
+        if tag == 'cvParam':
+            # Keep the position cvParams of the current spectrum
+            accession = element.get('accession')
+            if accession in (POSITION_X, POSITION_Y):
+                position[accession] = element.get('value')
+        elif tag == 'spectrum':
+            x.append(position[POSITION_X])
+            y.append(position[POSITION_Y])
+            position = {}
+            element.clear()
+
+    return np.stack([np.array(x).astype(np.int64), np.array(y).astype(np.int64)], axis=1)
 
-    # Extract the x,y coordinates from the mis file between the lines starting with '<Point>'
-    coordinates = []
-    for line in mis:
-        if line.startswith('<Point>'):
-            # Extract the text between the tags
-            point = line.split('>')[1].split('<')[0].split(',')
-            # Transform the text into a list of integers
-            point = [int(p) for p in point]
-            # Append the point to the list
-            coordinates.append(point)
 
-    # Transform the list of points into a numpy array
-    return np.array(coordinates)
+def read_peaks(peaks_dir: str) -> dict:
+    """Memory map the binary peak matrix written by maldi_peaks.R, without reading it
 
+    Args:
+        peaks_dir (str): Path to the directory of the matrix (e.g. results/mse_peaks_matrix)
+
+    Returns:
+        dict: The (n_pixels, n_mz) float32 intensities, the sorted m/z values, and the id and x,y coordinates of the pixels (read-only memory maps)
+    """
+    return {name: np.load(f'{peaks_dir}/{name}.npy', mmap_mode='r') for name in ('intensities', 'mz', 'id', 'x', 'y')}
 
-def countour_to_geojson(contour: np.ndarray, save: bool = False, name: str = 'contour') -> str:
+
+def mz_columns(mz: np.ndarray, lower: float = None, upper: float = None) -> slice:
+    """Get the columns of the peak matrix in an m/z range, as a slice giving views of the matrix
+
+    Args:
+        mz (np.ndarray): The sorted m/z values of the peak matrix
+        lower (float, optional): Lower m/z bound (included, no bound if None). Defaults to None.
+        upper (float, optional): Upper m/z bound (included, no bound if None). Defaults to None.
+
+    Returns:
+        slice: The columns of the m/z values in the range
+    """
+    start = 0 if lower is None else int(np.searchsorted(mz, lower, side='left'))
+    stop = len(mz) if upper is None else int(np.searchsorted(mz, upper, side='right'))
+
+    return slice(start, stop)
+
+
+def peak_rows(peak_ids: np.ndarray, ids: np.ndarray):
+    """Get the rows of the peak matrix of pixel ids
+
+    Args:
+        peak_ids (np.ndarray): The sorted ids of the pixels of the peak matrix
+        ids (np.ndarray): The ids of the pixels (e.g. the id column of pixels_maldi_warped_density_df.csv)
+
+    Raises:
+        ValueError: If some ids are not in the peak matrix
+
+    Returns:
+        slice or np.ndarray: The rows of the ids, as a slice giving views of the matrix if they are consecutive, otherwise as indices
+    """
+    ids = np.asarray(ids)
+    rows = np.minimum(np.searchsorted(peak_ids, ids), len(peak_ids) - 1)
+    missing = peak_ids[rows] != ids
+    if missing.any():
+        raise ValueError(f"{missing.sum()} pixel ids are not in the peak matrix (e.g. {ids[missing][0]})")
+
+    # Consecutive rows (e.g. all the pixels in the order of the spectra) are a slice
+    if len(rows) > 0 and np.all(np.diff(rows) == 1):
+        return slice(int(rows[0]), int(rows[-1]) + 1)
+
+    return rows
+
+
+def join_peaks(peaks: dict, ids: np.ndarray, lower: float = None, upper: float = None) -> tuple:
+    """Get the intensities of pixels in an m/z range, in the order of their ids, to join them with a table of the pixels
+
+    Only the rows and columns selected are read from the disk. When the ids are consecutive
+    (e.g. the whole density table), the intensities are a view of the memory mapped matrix.
+
+    Args:
+        peaks (dict): The peak matrix (see read_peaks)
+        ids (np.ndarray): The ids of the pixels (e.g. the id column of pixels_maldi_warped_density_df.csv)
+        lower (float, optional): Lower m/z bound (included, no bound if None). Defaults to None.
+        upper (float, optional): Upper m/z bound (included, no bound if None). Defaults to None.
+
+    Returns:
+        tuple: The (len(ids), n_selected_mz) intensities and the selected m/z values
+    """
+    columns = mz_columns(peaks['mz'], lower, upper)
+    rows = peak_rows(peaks['id'], ids)
+
+    return peaks['intensities'][rows, columns], peaks['mz'][columns]
+
+
+def countour_to_geojson(contour: np.ndarray, save: bool = False, name: str = 'contour', return_geojson: bool = True) -> str:
     """Transform the contour into geojson polygon.
 
     Args:
         contour (np.ndarray): The contour coordinates.
         save (bool, optional): If True it will save the file. Defaults to False.
         name (str, optional): The name of the file. Defaults to 'contour'.
+        return_geojson (bool, optional): If True it will return the geojson as a string, otherwise it is only streamed to the file. Defaults to True.
 
     Returns:
-        str: The geojson polygon.
+        str: The geojson polygon (None if return_geojson is False).
     """
     # Ensure the polygon is closed by making the first and last points the same
     if not np.array_equal(contour[0], contour[-1]):
         contour = np.vstack([contour, contour[0]])
 
-    # Create a GeoJSON Polygon
-    contour_polygon = FeatureCollection([Feature(geometry=Polygon([contour.tolist()]),
-                                         id="1",
-                                         properties={"objectType": "contour"})])
-
-    # Get geojson as string
-    contour_geojson = dumps(contour_polygon)
+    # Round the coordinates as geojson does
+    polygons = np.round(contour[np.newaxis], 6)
 
-    # save the results in a text if required
+    # Stream the geojson to the file if required
     if save:
         with open(f'{name}.geojson', 'w') as f:
-            f.write(contour_geojson)
+            write_feature_collection(f, polygons, object_type="contour")
 
-    return contour_geojson
+    # Get geojson as string if required
+    if return_geojson:
+        contour_geojson = io.StringIO()
+        write_feature_collection(contour_geojson, polygons, object_type="contour")
+        return contour_geojson.getvalue()
 
 
 def align_coord_contour(coord: np.array, contour: np.array, conserve_dimensions: bool=False) -> np.array:
@@ -103,6 +301,7 @@ def align_coord_contour(coord: np.array, contour: np.array, conserve_dimensions:
     contour_polygon = Polygon([contour.tolist()])
 
     # Create a GeoDataFrame
+    import geopandas as gpd
     gdf = gpd.GeoDataFrame(geometry=[contour_polygon])
 
     # Compute the centroid of the contour polygon
@@ -148,7 +347,7 @@ def align_coord_contour(coord: np.array, contour: np.array, conserve_dimensions:
     
     return coord
 
-def coord_to_geojson(x_coord: np.ndarray, y_coord: np.ndarray, save: bool = False, name: str = 'pixels') -> str:
+def coord_to_geojson(x_coord: np.ndarray, y_coord: np.ndarray, save: bool = False, name: str = 'pixels', return_geojson: bool = True) -> str:
     """
     Transform the x,y coordinates into pixels in the form of geojson text.
 
@@ -163,46 +362,37 @@ def coord_to_geojson(x_coord: np.ndarray, y_coord: np.ndarray, save: bool = Fals
     name : str
         If save is True it will name the file and control the directory (default 'pixels').
         The extension (.geojson) is added automaticaly.
+    return_geojson : bool
+        If True it will return the geojson text, otherwise it is only streamed to the file (default True).
 
     Returns
     -------
     str
         Feature collection, with each feature has geometry of polygon.
         Each polygon correspond to a pixel in your coordinates.
+        None if return_geojson is False.
 
     Example
     -------
     >>> coord_to_geojson(np.array([1., 2.]), np.array([3., 4.]))
-    '{"type": "FeatureCollection", "features": [{"type": "Feature", "id": "pixel(1.0, 3.0)", "geometry": {"type": "Polygon", "coordinates": [[[1.0, 3.0], [1.0, 4.0], [2.0, 4.0], [2.0, 3.0], [1.0, 3.0]]]}, "properties": {"objectType": "annotation"}}, {"type": "Feature", "id": "pixel(2.0, 4.0)", "geometry": {"type": "Polygon", "coordinates": [[[2.0, 4.0], [2.0, 5.0], [3.0, 5.0], [3.0, 4.0], [2.0, 4.0]]]}, "properties": {"objectType": "annotation"}}]}'
+    '{"type": "FeatureCollection", "features": [{"type": "Feature", "id": "1", "geometry": {"type": "Polygon", "coordinates": [[[0.5, 2.5], [0.5, 3.5], [1.5, 3.5], [1.5, 2.5], [0.5, 2.5]]]}, "properties": {"objectType": "pixel"}}, {"type": "Feature", "id": "2", "geometry": {"type": "Polygon", "coordinates": [[[1.5, 3.5], [1.5, 4.5], [2.5, 4.5], [2.5, 3.5], [1.5, 3.5]]]}, "properties": {"objectType": "pixel"}}]}'
     """
-    # Compute the distance between points
-    edges_x = np.unique(np.round(np.diff(np.sort(np.unique(x_coord))), 6))
-    edges_y = np.unique(np.round(np.diff(np.sort(np.unique(y_coord))), 6))
-    
-    # Assert if the values aren't unique and equal
-    # assert edges_x == edges_y, "The distance between points on x axis and y axis are different"
-    # assert edges_x.shape[0] == 1 and edges_y.shape[0] == 1, "The distance between points is not unique"
-    
-    # Obtain the pixel edge
-    lx = edges_x[0]/2
-    ly = edges_y[0]/2
-
-    # Append a square polygon for each point in feature collection
-    polygons = FeatureCollection([Feature(geometry=Polygon([[(x-lx, y-ly),
-                                                             (x-lx, y+ly),
-                                                             (x+lx, y+ly),
-                                                             (x+lx, y-ly),
-                                                             (x-lx, y-ly)]]),
-                                          id=f"{i+1}",
-                                          properties={"objectType": "pixel"})
-                                  for i, (x, y) in enumerate(zip(x_coord, y_coord))])
-
-    # Get geojson as string
-    pixels_geojson = dumps(polygons)
-
-    # save the results in a text if required
+    # Compute the pixel size from the distance between points
+    size = pixel_size(x_coord, y_coord)
+
+    # Compute the corners of the square polygon of all the points at once
+    polygons = pixel_corners(x_coord, y_coord, size)
+
+    # Round the coordinates as geojson does
+    polygons = np.round(polygons, 6)
+
+    # Stream the geojson to the file if required
     if save:
         with open(f'{name}.geojson', 'w') as f:
-            f.write(pixels_geojson)
+            write_feature_collection(f, polygons, object_type="pixel")
 
-    return pixels_geojson
\ No newline at end of file
+    # Get geojson as string if required
+    if return_geojson:
+        pixels_geojson = io.StringIO()
+        write_feature_collection(pixels_geojson, polygons, object_type="pixel")
+        return pixels_geojson.getvalue()